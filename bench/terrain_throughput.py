@@ -0,0 +1,213 @@
+# Throughput of scripts/build_terrain_rgb.py on synthetic DEMs, for comparison across
+# commits. The other terrain_*.py benches measure output size through `rio rgbify`;
+# this one measures the speed of the builder itself.
+#
+# Three sources are generated once in bench/terrain/synthetic, all sampled from the
+# same analytic terrain so that they agree where they overlap:
+#   coarse : 1 arcsec EPSG:4326 over the whole window, the global-like fallback
+#   fine   : 10m EPSG:3857, a partial irregular footprint (nodata outside)
+#   mosaic : 5m EPSG:3857 split in 4x4 files, read through the R-tree index
+#
+# Each scenario is built end to end at fixed settings with --profile, and reported as
+# tiles/s, macrotiles/s, bytes/tile, peak memory and the wall time per stage:
+#
+#   python bench/terrain_throughput.py                  # -> bench/terrain/throughput_<commit>.json
+#   python bench/terrain_throughput.py --compare a.json b.json
+
+import argparse
+import json
+import math
+import os
+import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+OUT = "bench/terrain"
+SYN = f"{OUT}/synthetic"
+BOUNDS = (6.0, 45.0, 6.4, 45.3)
+SETTINGS = [
+    "--minzoom", "8", "--maxzoom", "14", "--tile-size", "512", "--macro-levels", "2",
+    "--blur", "500", "--encoding", "terrarium", "--vertical-step", "26.8", "-f", "webp",
+]
+SCENARIOS = {
+    "coarse": ["coarse"],
+    "coarse_fine": ["coarse", "fine"],
+    "all": ["coarse", "fine", "mosaic"],
+}
+NODATA = -9999.0
+R = 6378137.0
+
+
+def elevation(lon, lat):
+    """smooth ridges and valleys, a few hundred to a few thousand metres"""
+    x, y = np.radians(lon) * 60.0, np.radians(lat) * 60.0
+    z = 1500.0 + 900.0 * np.sin(x * 1.3 + np.cos(y * 0.7)) * np.cos(y * 1.1)
+    z += 300.0 * np.sin(x * 7.1 + y * 3.3) + 80.0 * np.cos(x * 29.0 - y * 23.0)
+    z += 15.0 * np.sin(x * 131.0) * np.sin(y * 117.0)
+    return z.astype(np.float32)
+
+
+def mercator(lon, lat):
+    return math.radians(lon) * R, R * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+
+def lonlat(x, y):
+    return np.degrees(x / R), np.degrees(2 * np.arctan(np.exp(y / R)) - np.pi / 2)
+
+
+def write(path, data, transform, crs):
+    profile = dict(
+        driver="GTiff", height=data.shape[0], width=data.shape[1], count=1,
+        dtype="float32", crs=crs, transform=transform, nodata=NODATA,
+        tiled=True, blockxsize=256, blockysize=256, compress="deflate",
+    )
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+
+
+def generate():
+    """the three sources and their sources.json, once"""
+    os.makedirs(f"{SYN}/mosaic", exist_ok=True)
+    w, s, e, n = BOUNDS
+    if not os.path.exists(f"{SYN}/coarse.tif"):
+        res = 1 / 3600.0
+        west, north = w - 0.1, n + 0.1
+        cols, rows = round((e - w + 0.2) / res), round((n - s + 0.2) / res)
+        lon = west + (np.arange(cols) + 0.5) * res
+        lat = north - (np.arange(rows) + 0.5) * res
+        write(f"{SYN}/coarse.tif", elevation(*np.meshgrid(lon, lat)),
+              from_origin(west, north, res, res), "EPSG:4326")
+
+    cx, cy = mercator((w + e) / 2, (s + n) / 2)
+    if not os.path.exists(f"{SYN}/fine.tif"):
+        res, size = 10.0, 2400
+        west, north = cx - size * res / 2, cy + size * res / 2
+        xs = west + (np.arange(size) + 0.5) * res
+        ys = north - (np.arange(size) + 0.5) * res
+        gx, gy = np.meshgrid(xs, ys)
+        z = elevation(*lonlat(gx, gy))
+        # a lobed footprint, so that the fade along its edge is exercised
+        angle = np.arctan2(gy - cy, gx - cx)
+        radius = size * res * (0.32 + 0.1 * np.sin(3 * angle))
+        z[np.hypot(gx - cx, gy - cy) > radius] = NODATA
+        write(f"{SYN}/fine.tif", z, from_origin(west, north, res, res), "EPSG:3857")
+
+    files = sorted(f for f in os.listdir(f"{SYN}/mosaic") if f.endswith(".tif"))
+    if len(files) != 16:
+        res, size = 5.0, 600
+        for j in range(4):
+            for i in range(4):
+                west = cx + (i - 2) * size * res
+                north = cy + (2 - j) * size * res
+                xs = west + (np.arange(size) + 0.5) * res
+                ys = north - (np.arange(size) + 0.5) * res
+                gx, gy = np.meshgrid(xs, ys)
+                write(f"{SYN}/mosaic/{i}_{j}.tif", elevation(*lonlat(gx, gy)),
+                      from_origin(west, north, res, res), "EPSG:3857")
+
+    specs = {
+        "coarse": {"name": "bench_coarse", "type": "raster", "path": f"{SYN}/coarse.tif"},
+        "fine": {"name": "bench_fine", "type": "raster", "path": f"{SYN}/fine.tif"},
+        "mosaic": {"name": "bench_mosaic", "type": "raster",
+                   "path": f"{SYN}/mosaic/*.tif", "index": True},
+    }
+    for name, sources in SCENARIOS.items():
+        with open(f"{SYN}/{name}.json", "w") as f:
+            json.dump({"sources": [specs[s] for s in sources]}, f, indent=2)
+
+
+def run(name, jobs):
+    output = f"{SYN}/{name}.mbtiles"
+    profile = f"{SYN}/{name}.profile.json"
+    cmd = [
+        sys.executable, "scripts/build_terrain_rgb.py", "--sources", f"{SYN}/{name}.json",
+        "--bounds", ",".join(map(str, BOUNDS)), "-j", str(jobs),
+        "--workdir", f"{SYN}/work_{name}", "--profile", profile, "-o", output,
+    ] + SETTINGS
+    start = time.monotonic()
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    wall = time.monotonic() - start
+    if proc.returncode:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit(f"{name}: build_terrain_rgb failed")
+
+    with sqlite3.connect(output) as db:
+        tiles = db.execute("SELECT count(*) FROM tiles_shallow").fetchone()[0]
+        size = db.execute("SELECT coalesce(sum(length(tile_data)), 0) FROM tiles").fetchone()[0]
+    m = re.search(r"tiles in (\d+) macrotiles", proc.stderr)
+    macrotiles = int(m.group(1)) if m else 0
+    report = json.load(open(profile))
+    return {
+        "wall_s": round(wall, 2),
+        "tiles": tiles,
+        "macrotiles": macrotiles,
+        "tiles_per_s": round(tiles / wall, 1),
+        "macrotiles_per_s": round(macrotiles / wall, 2),
+        "bytes_per_tile": round(size / max(tiles, 1)),
+        "worker_peak_mb": max((z["max_mb"] for z in report["peak_rss"].values()), default=0),
+        "stages_s": {k: v["total_s"] for k, v in report["stages"].items()},
+    }
+
+
+def compare(a_path, b_path):
+    a, b = json.load(open(a_path)), json.load(open(b_path))
+    print(f"{a['commit'][:10]} -> {b['commit'][:10]}")
+    keys = ("wall_s", "tiles_per_s", "macrotiles_per_s", "bytes_per_tile", "worker_peak_mb")
+    for name in b["scenarios"]:
+        if name not in a["scenarios"]:
+            continue
+        ra, rb = a["scenarios"][name], b["scenarios"][name]
+        print(f"\n=== {name} ===")
+        for k in keys:
+            print(f"{k:<18} {ra[k]:>10} {rb[k]:>10} {100 * (rb[k] - ra[k]) / (ra[k] or 1):>+8.1f}%")
+        for k in sorted(set(ra["stages_s"]) | set(rb["stages_s"])):
+            sa, sb = ra["stages_s"].get(k, 0), rb["stages_s"].get(k, 0)
+            print(f"  {k:<16} {sa:>10} {sb:>10}")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("-j", "--jobs", type=int, default=4)
+    p.add_argument("--scenario", action="append", choices=tuple(SCENARIOS))
+    p.add_argument("-o", "--output")
+    p.add_argument("--compare", nargs=2, metavar="JSON")
+    a = p.parse_args()
+    if a.compare:
+        compare(*a.compare)
+        return
+
+    generate()
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+    ).stdout.strip() or "unknown"
+    results = {}
+    for name in a.scenario or SCENARIOS:
+        results[name] = run(name, a.jobs)
+        r = results[name]
+        print(f"  {name}: {r['tiles']} tiles in {r['wall_s']}s, {r['tiles_per_s']} tiles/s, "
+              f"{r['bytes_per_tile']} B/tile, workers {r['worker_peak_mb']} MB", flush=True)
+    # the largest of the waited for processes, the main one of the heaviest build
+    main_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    main_peak = main_peak / 1048576.0 if sys.platform == "darwin" else main_peak / 1024.0
+    out = {
+        "commit": commit,
+        "settings": SETTINGS + ["-j", str(a.jobs)],
+        "bounds": BOUNDS,
+        "main_peak_mb": round(main_peak, 1),
+        "scenarios": results,
+    }
+    path = a.output or f"{OUT}/throughput_{commit[:10]}.json"
+    with open(path, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
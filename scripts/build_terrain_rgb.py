@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 """
-Build terrain RGB mbtiles from any number of elevation sources, mapterhorn style:
+Build terrain RGB mbtiles (or pmtiles) from any number of elevation sources, mapterhorn style:
 the max zoom is warped once per macrotile and every lower zoom is a 2x2 average of
 the tiles already produced, instead of one full pass over the dem per zoom.
 
@@ -12,15 +12,30 @@ one without leaving a step along the edge of its coverage.
 from __future__ import division
 
 import argparse
+import array
+import base64
+import collections
+import concurrent.futures
+import contextlib
 import glob as globlib
+import gzip
+import hashlib
+import http.client
 import io
 import json
 import math
 import os
+import queue
 import re
+import resource
+import shutil
 import sqlite3
+import struct
 import subprocess
 import sys
+import threading
+import time
+import urllib.parse
 import urllib.request
 from multiprocessing import Pool
 
@@ -29,11 +44,15 @@ import numpy as np
 import rasterio
 from PIL import Image
 from rasterio.enums import Resampling
-from rasterio.warp import reproject
+from rasterio.merge import merge
+from rasterio.warp import reproject, transform_bounds
 from rasterio import transform as riotransform
+import shapely
+import shapely.wkb
 from shapely import geometry
+from shapely.ops import unary_union
+from shapely.prepared import prep
 
-from rio_rgbify.encoders import data_to_rgb
 from rio_rgbify.mbtiler import parse_poly
 
 CATALOG_URL = "https://raw.githubusercontent.com/mapterhorn/mapterhorn/main/source-catalog"
@@ -57,6 +76,66 @@ def log(msg):
     print(msg, file=sys.stderr, flush=True)
 
 
+# --profile: the stages timed in this process, as (name, tags, pid, thread,
+# start, seconds), handed back to the main process with every job. None when
+# not profiling, and then `stage` costs nothing
+PROFILE = {"events": None}
+# the TileWriter thread records its stages while the main one drains them
+_PROFILE_LOCK = threading.Lock()
+# the tags of the stages a thread is in, inherited by the stages nested in them
+_STAGE_TAGS = threading.local()
+
+
+def stage(name, **tags):
+    """time a stage of the build when profiling"""
+    if PROFILE["events"] is None:
+        return contextlib.nullcontext()
+    return _timed(name, tags)
+
+
+@contextlib.contextmanager
+def _timed(name, tags):
+    outer = getattr(_STAGE_TAGS, "tags", {})
+    tags = dict(outer, **tags)
+    _STAGE_TAGS.tags = tags
+    start = time.time()
+    try:
+        yield
+    finally:
+        _STAGE_TAGS.tags = outer
+        event = (name, tags, os.getpid(), threading.get_ident(), start, time.time() - start)
+        with _PROFILE_LOCK:
+            PROFILE["events"].append(event)
+
+
+def _drain_profile():
+    with _PROFILE_LOCK:
+        events, PROFILE["events"] = PROFILE["events"], []
+    return events
+
+
+def _peak_rss(reset=False):
+    """
+    peak RSS of this process in bytes. Linux can reset it, so that it is the
+    peak of one macrotile; elsewhere it is the peak of the process so far
+    """
+    try:
+        if reset:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return 0
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) << 10
+    except OSError:
+        pass
+    if reset:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss << 10
+
+
 # --------------------------------------------------------------------------
 # sources
 # --------------------------------------------------------------------------
@@ -87,25 +166,117 @@ def _human(n):
         n /= 1024.0
 
 
-def _download(url, dest, retries=4):
-    if os.path.exists(dest) and os.path.getsize(dest) > 0:
-        return dest
-    os.makedirs(os.path.dirname(dest), exist_ok=True)
-    tmp = dest + ".part"
-
-    for attempt in range(retries):
-        offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
-        req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
-        mode = "wb"
-        if offset:
-            # these deliveries are several GB per part, resume rather than restart
-            req.add_header("Range", "bytes=%d-" % offset)
-            mode = "ab"
-        try:
-            with urllib.request.urlopen(req, timeout=120) as r:
+class Downloader(object):
+    """
+    Downloads on `jobs` threads, each keeping one connection per host alive
+    across its files: a source of a few hundred archive parts is otherwise
+    one file at a time, and mostly round trips and slow starts. A download
+    goes to a .part file first, and an interrupted one is resumed with a
+    Range request rather than restarted.
+
+    HTTP_PROXY, HTTPS_PROXY and NO_PROXY are honoured as urllib does: plain
+    http goes to the proxy with the full url, https through a CONNECT tunnel.
+    """
+
+    def __init__(self, jobs=1, retries=4):
+        self.jobs = jobs
+        self.retries = retries
+        self.proxies = urllib.request.getproxies()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.files = 0
+        self.elapsed = 0.0
+
+    def _proxy(self, scheme, host):
+        """the proxy to reach `host` through, split, or None"""
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(host):
+            return None
+        return urllib.parse.urlsplit(proxy if "://" in proxy else "http://" + proxy)
+
+    def _connection(self, scheme, host):
+        conns = self.local.__dict__.setdefault("conns", {})
+        conn = conns.get((scheme, host))
+        if conn is None:
+            cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            proxy = self._proxy(scheme, host)
+            if proxy is None:
+                conn = cls(host, timeout=120)
+            else:
+                auth = {}
+                if proxy.username:
+                    login = "%s:%s" % (
+                        urllib.parse.unquote(proxy.username),
+                        urllib.parse.unquote(proxy.password or ""),
+                    )
+                    auth["Proxy-Authorization"] = "Basic " + base64.b64encode(
+                        login.encode()
+                    ).decode()
+                at = proxy.netloc.rpartition("@")[2]
+                conn = cls(at, timeout=120)
+                if scheme == "https":
+                    conn.set_tunnel(host, headers=auth)
+                else:
+                    # sent with every request, which asks for the full url
+                    conn.proxy_headers = auth
+            conns[(scheme, host)] = conn
+        return conn
+
+    def _drop(self, url):
+        """after an error the connection is in an unknown state"""
+        u = urllib.parse.urlsplit(url)
+        conn = self.local.__dict__.get("conns", {}).pop((u.scheme, u.netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def _open(self, url, headers):
+        """the response to a GET of `url`, and the url it was found at"""
+        for _ in range(10):
+            u = urllib.parse.urlsplit(url)
+            conn = self._connection(u.scheme, u.netloc)
+            target = u.path + ("?" + u.query if u.query else "")
+            sent = headers
+            if u.scheme == "http" and hasattr(conn, "proxy_headers"):
+                target = urllib.parse.urlunsplit(u._replace(fragment=""))
+                sent = dict(headers, **conn.proxy_headers)
+            try:
+                conn.request("GET", target, headers=sent)
+                r = conn.getresponse()
+            except Exception:
+                # a kept alive connection the server closed in between, mostly
+                self._drop(url)
+                raise
+            if r.status in (301, 302, 303, 307, 308):
+                r.read()
+                url = urllib.parse.urljoin(url, r.getheader("Location"))
+                continue
+            if r.status >= 400:
+                r.read()
+                raise IOError("HTTP %d %s" % (r.status, r.reason))
+            return r, url
+        raise IOError("too many redirects")
+
+    def fetch(self, url, dest):
+        if os.path.exists(dest) and os.path.getsize(dest) > 0:
+            return dest
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = dest + ".part"
+
+        for attempt in range(self.retries):
+            offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+            headers = {"User-Agent": USER_AGENT}
+            mode = "wb"
+            if offset:
+                # these deliveries are several GB per part, resume rather than restart
+                headers["Range"] = "bytes=%d-" % offset
+                mode = "ab"
+            at = url
+            try:
+                r, at = self._open(url, headers)
                 if mode == "ab" and r.status != 206:
                     mode, offset = "wb", 0  # server ignored the range
-                total = r.headers.get("Content-Length")
+                total = r.getheader("Content-Length")
                 log(
                     "  download %s%s%s"
                     % (
@@ -114,19 +285,50 @@ def _download(url, dest, retries=4):
                         " of %s" % _human(int(total) + offset) if total else "",
                     )
                 )
+                got = 0
                 with open(tmp, mode) as f:
                     while True:
                         chunk = r.read(1 << 20)
                         if not chunk:
                             break
                         f.write(chunk)
-            os.rename(tmp, dest)
-            return dest
-        except Exception as exc:
-            if attempt == retries - 1:
-                raise
-            log("  %s: %s, retrying" % (os.path.basename(url), exc))
-    return dest
+                        got += len(chunk)
+                        with self.lock:
+                            self.bytes += len(chunk)
+                # a connection dropped mid body reads as a clean end
+                if total and got < int(total):
+                    raise IOError("truncated at %s" % _human(offset + got))
+                os.rename(tmp, dest)
+                with self.lock:
+                    self.files += 1
+                return dest
+            except Exception as exc:
+                self._drop(at)
+                if attempt == self.retries - 1:
+                    raise
+                log("  %s: %s, retrying" % (os.path.basename(url), exc))
+        return dest
+
+    def fetch_all(self, items):
+        """(url, dest) pairs, `jobs` at a time"""
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            for _ in pool.map(lambda item: self.fetch(*item), items):
+                pass
+        self.elapsed += time.monotonic() - start
+
+    def report(self):
+        return "downloaded %d file(s), %s in %.0fs, %s/s on %d connection(s)" % (
+            self.files,
+            _human(self.bytes),
+            self.elapsed,
+            _human(self.bytes / max(self.elapsed, 1e-3)),
+            self.jobs,
+        )
+
+
+def _download(url, dest, retries=4):
+    return Downloader(retries=retries).fetch(url, dest)
 
 
 def _build_vrt(files, vrt_path, extra=()):
@@ -151,7 +353,7 @@ def prepare_valhalla(spec, bbox, workdir):
             ["valhalla_build_elevation", "-d", "-b", bounds, "-o", path], check=True
         )
     w, s, e, n = bbox
-    files = []
+    files, boxes = [], []
     for lat in range(int(math.floor(s)), int(math.ceil(n))):
         for lon in range(int(math.floor(w)), int(math.ceil(e))):
             name = "%s%02d%s%03d.hgt" % (
@@ -163,7 +365,11 @@ def prepare_valhalla(spec, bbox, workdir):
             candidate = os.path.join(path, name[:3], name)
             if os.path.exists(candidate):
                 files.append(candidate)
+                boxes.append((lon, lat, lon + 1, lat + 1))
     log("  %d hgt tiles" % len(files))
+    if boxes:
+        spec["_coverage"] = _coverage_wkb(boxes)
+    _record_files(spec, files, dict(zip(files, boxes)))
     return _build_vrt(sorted(files), os.path.join(workdir, spec["name"] + ".vrt"))
 
 
@@ -176,9 +382,10 @@ def prepare_raster(spec, bbox, workdir):
             found = [pattern]
         files.extend(found)
     log("  %d file(s)" % len(files))
-    if len(files) == 1:
+    if len(files) == 1 and not spec.get("index"):
+        _record_files(spec, files)
         return files[0]
-    return _build_vrt(files, os.path.join(workdir, spec["name"] + ".vrt"))
+    return _mosaic(spec, files, workdir, os.path.join(workdir, spec["name"]))
 
 
 RASTER_EXT = (".tif", ".tiff", ".asc", ".img", ".dt1", ".dt2", ".hgt", ".vrt")
@@ -234,6 +441,17 @@ def _extract(archive, dest):
         subprocess.run([seven, "x", "-y", "-o" + dest, archive], check=True)
 
 
+def _item_downloads(urls, cache):
+    """the (url, dest) pairs `_ensure_item` still has to download for an item"""
+    stem = _archive_stem(os.path.basename(urls[0]))
+    if stem is None:
+        return [(urls[0], os.path.join(cache, os.path.basename(urls[0])))]
+    extracted = os.path.join(cache, "extracted", stem)
+    if os.path.isdir(extracted) and _find_rasters(extracted):
+        return []
+    return [(u, os.path.join(cache, "archives", os.path.basename(u))) for u in urls]
+
+
 def _ensure_item(urls, cache):
     """
     Materialize one item of a file list, which is either a plain raster or an
@@ -253,37 +471,192 @@ def _ensure_item(urls, cache):
         return rasters
 
     parts = [_download(u, os.path.join(cache, "archives", os.path.basename(u))) for u in urls]
-    _extract(sorted(parts)[0], extracted)
+    # extracted aside: a folder left half done by an interrupted run would
+    # otherwise pass for a complete one
+    tmp = extracted + ".part"
+    shutil.rmtree(tmp, ignore_errors=True)
+    _extract(sorted(parts)[0], tmp)
+    shutil.rmtree(extracted, ignore_errors=True)
+    os.rename(tmp, extracted)
     rasters = _find_rasters(extracted)
     if not rasters:
         raise SystemExit("no raster found in %s after extracting %s" % (extracted, stem))
     return rasters
 
 
-def _bounds_index(paths, cache):
-    """wgs84 bounds of each file, cached: opening 100k rasters is not free"""
-    from rasterio.warp import transform_bounds
+def _file_bounds(path, crs=None):
+    """wgs84 bounds of a raster, None when it has no crs or does not open"""
+    try:
+        with rasterio.open(path) as src:
+            src_crs = src.crs or crs
+            if src_crs is None:
+                return None
+            return list(transform_bounds(src_crs, "EPSG:4326", *src.bounds))
+    except Exception:
+        return None
+
+
+def _bounds_index(paths, cache, crs=None, jobs=1):
+    """
+    wgs84 bounds of each file, cached: opening 100k rasters is not free. `crs`
+    is the one of the files that carry none, as the `crs` of the spec.
 
-    index_path = os.path.join(cache, "bounds.json")
-    index = {}
+    The cache is a log of [path, size, mtime, bounds] lines, appended to as
+    the files are opened on `jobs` processes: an interrupted run keeps what it
+    did, and a file whose size or mtime changed is opened again
+    """
+    index_path = os.path.join(cache, "bounds.jsonl")
+    known = {}
     if os.path.exists(index_path):
-        index = json.load(open(index_path))
-    missing = [p for p in paths if p not in index]
-    if missing:
-        log("  indexing %d file(s)" % len(missing))
-        for p in missing:
+        with open(index_path) as f:
+            for line in f:
+                try:
+                    path, size, mtime, bounds = json.loads(line)
+                except ValueError:
+                    continue  # the last line of an interrupted run
+                known[path] = (size, mtime, bounds)
+    # the bounds.json of earlier versions, trusted once and moved to the log
+    legacy = {}
+    if os.path.exists(os.path.join(cache, "bounds.json")):
+        legacy = json.load(open(os.path.join(cache, "bounds.json")))
+
+    index, missing, adopted = {}, [], []
+    for p in paths:
+        st = os.stat(p)
+        entry = known.get(p)
+        if entry is None and legacy.get(p) is not None:
+            entry = (st.st_size, st.st_mtime_ns, legacy[p])
+            adopted.append((p, st, legacy[p]))
+        if entry is None or entry[:2] != (st.st_size, st.st_mtime_ns) or (
+            crs and entry[2] is None
+        ):
+            missing.append((p, st))
+        else:
+            index[p] = entry[2]
+    if not missing and not adopted:
+        return index
+
+    os.makedirs(cache, exist_ok=True)
+    with open(index_path, "ab") as f:
+        if f.tell() and open(index_path, "rb").read()[-1:] != b"\n":
+            f.write(b"\n")
+
+        def record(p, st, bounds):
+            f.write(json.dumps([p, st.st_size, st.st_mtime_ns, bounds]).encode() + b"\n")
+
+        for p, st, bounds in adopted:
+            record(p, st, bounds)
+        if missing:
+            log("  indexing %d file(s) on %d process(es)" % (len(missing), jobs))
+            start = time.monotonic()
+            names = [p for p, _ in missing]
+            if jobs > 1 and len(missing) > 1:
+                pool = concurrent.futures.ProcessPoolExecutor(jobs)
+                results = pool.map(_file_bounds, names, [crs] * len(names), chunksize=64)
+            else:
+                pool = None
+                results = (_file_bounds(p, crs) for p in names)
             try:
-                with rasterio.open(p) as src:
-                    if src.crs is None:
-                        index[p] = None
-                    else:
-                        index[p] = list(transform_bounds(src.crs, "EPSG:4326", *src.bounds))
-            except Exception:
-                index[p] = None
-        json.dump(index, open(index_path, "w"))
+                for i, ((p, st), bounds) in enumerate(zip(missing, results)):
+                    index[p] = bounds
+                    record(p, st, bounds)
+                    if i % 1000 == 999:
+                        f.flush()
+                        log("  %d/%d file(s) indexed" % (i + 1, len(missing)))
+            finally:
+                if pool is not None:
+                    pool.shutdown(cancel_futures=True)
+            log("  indexed %d file(s) in %.0fs" % (len(missing), time.monotonic() - start))
     return index
 
 
+def _file_index(files, bounds, index_path, crs=None):
+    """
+    An R-tree of the files of a source, in EPSG:3857, next to their paths. For
+    sources of tens of thousands of files a single vrt is slow to open and to
+    warp through in every worker: with this, a worker only opens the few files
+    under the block it warps. Rebuilt only when the list of files changes.
+    """
+    key = hashlib.sha1("\n".join(files).encode()).hexdigest()
+    if os.path.exists(index_path):
+        conn = sqlite3.connect(index_path)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE name='files'").fetchone()
+        except sqlite3.Error:
+            row = None
+        conn.close()
+        if row and row[0] == key:
+            return index_path
+
+    indexed = [(p, bounds[p]) for p in files if bounds.get(p) is not None]
+    if len(indexed) < len(files):
+        log("  %d file(s) without a crs left out of the index" % (len(files) - len(indexed)))
+    if not indexed:
+        raise SystemExit("no file to index in %s" % index_path)
+    with rasterio.open(indexed[0][0]) as src:
+        if src.crs is None and crs:
+            res = abs(src.transform.a)
+            if rasterio.crs.CRS.from_user_input(crs).is_geographic:
+                res *= 111320.0
+        else:
+            res = source_resolution_m(src)
+
+    tmp = index_path + ".tmp"
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    conn = sqlite3.connect(tmp)
+    conn.execute("CREATE TABLE meta (name text primary key, value text)")
+    conn.execute("CREATE TABLE files (id integer primary key, path text)")
+    conn.execute("CREATE VIRTUAL TABLE files_rtree USING rtree(id, minx, maxx, miny, maxy)")
+    extent = [180.0, 90.0, -180.0, -90.0]
+    for i, (path, (w, s, e, n)) in enumerate(indexed):
+        (x0, x1), (y0, y1) = to_mercator(np.array([w, e]), np.array([s, n]))
+        conn.execute("INSERT INTO files (id, path) VALUES (?, ?)", (i, path))
+        conn.execute(
+            "INSERT INTO files_rtree (id, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)",
+            (i, float(x0), float(x1), float(y0), float(y1)),
+        )
+        extent = [min(extent[0], w), min(extent[1], s), max(extent[2], e), max(extent[3], n)]
+    meta = {"files": key, "resolution": res, "bounds": json.dumps(extent), "crs": crs or ""}
+    conn.executemany("INSERT INTO meta (name, value) VALUES (?, ?)", meta.items())
+    conn.commit()
+    conn.close()
+    os.replace(tmp, index_path)
+    log("  indexed %d file(s) in %s" % (len(indexed), index_path))
+    return index_path
+
+
+def _record_files(spec, files, boxes=None):
+    """
+    The files of a source with their mtime, size and wgs84 box when known: the
+    block cache keys a block on the files under it, not on the vrt, which is
+    rebuilt by every build and lists the files of its area only
+    """
+    boxes = boxes or {}
+    out = []
+    for p in files:
+        st = os.stat(p)
+        out.append((p, st.st_mtime_ns, st.st_size, boxes.get(p)))
+    spec["_files"] = out
+
+
+def _mosaic(spec, files, workdir, cache, boxes=None):
+    """the vrt of the files, or their R-tree when the spec asks for `index`"""
+    if spec.get("index"):
+        spec["_index"] = True
+        bounds = _bounds_index(files, cache, spec.get("crs"), spec.get("_jobs", 1))
+        _record_files(spec, files, bounds)
+        return _file_index(
+            files, bounds, os.path.join(workdir, spec["name"] + ".index.sqlite"), spec.get("crs")
+        )
+    _record_files(spec, files, boxes)
+    vrt = _build_vrt(files, os.path.join(workdir, spec["name"] + ".vrt"))
+    if spec.get("crs"):
+        # .asc deliveries carry no projection, mapterhorn sets it in its Justfile
+        subprocess.run(["gdal_edit.py", "-a_srs", spec["crs"], vrt], check=True)
+    return vrt
+
+
 def prepare_mapterhorn(spec, bbox, workdir):
     """
     A source of the mapterhorn source-catalog. `path` is either a catalog name,
@@ -328,23 +701,50 @@ def prepare_mapterhorn(spec, bbox, workdir):
         log("  %d item(s) cannot be filtered before download" % len(unnamed))
     log("  %d/%d items to materialize" % (len(named) + len(unnamed), len(groups)))
 
-    files = []
-    for group in named + unnamed:
-        files.extend(_ensure_item(group, cache))
+    downloads = [
+        (url, dest)
+        for group in named + unnamed
+        for url, dest in _item_downloads(group, cache)
+        if not (os.path.exists(dest) and os.path.getsize(dest) > 0)
+    ]
+    if downloads:
+        downloader = Downloader(spec.get("_download_jobs", 4))
+        log("  %d file(s) to download" % len(downloads))
+        downloader.fetch_all(downloads)
+        log("  " + downloader.report())
+
+    # extraction is one archive per process, 7z or zipfile alike are bound to a core
+    items = named + unnamed
+    jobs = spec.get("_jobs", 1)
+    if jobs > 1 and len(items) > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            materialized = list(pool.map(_ensure_item, items, [cache] * len(items)))
+    else:
+        materialized = [_ensure_item(group, cache) for group in items]
+
+    files, file_boxes = [], {}
+    for group, rasters in zip(items, materialized):
+        files.extend(rasters)
+        tile_bounds = _degree_tile_bounds(group[0])
+        if tile_bounds is not None:
+            file_boxes.update(dict.fromkeys(rasters, tile_bounds))
     log("  %d raster(s)" % len(files))
 
+    boxes = [_degree_tile_bounds(group[0]) for group in named]
     if unnamed:
         # now that they are on disk, drop what does not touch the area
-        index = _bounds_index(files, cache)
+        index = _bounds_index(files, cache, spec.get("crs"), spec.get("_jobs", 1))
         kept = [p for p in files if index.get(p) is None or _intersects(index[p], bbox)]
         log("  %d raster(s) intersect the area" % len(kept))
         files = kept
+        boxes += [index.get(p) for p in files]
+        for p in files:
+            if p not in file_boxes and index.get(p) is not None:
+                file_boxes[p] = index[p]
+    if boxes and all(b is not None for b in boxes):
+        spec["_coverage"] = _coverage_wkb(boxes)
 
-    vrt = _build_vrt(files, os.path.join(workdir, spec["name"] + ".vrt"))
-    if spec.get("crs"):
-        # .asc deliveries carry no projection, mapterhorn sets it in its Justfile
-        subprocess.run(["gdal_edit.py", "-a_srs", spec["crs"], vrt], check=True)
-    return vrt
+    return _mosaic(spec, files, workdir, cache, file_boxes)
 
 
 PREPARE = {
@@ -363,16 +763,43 @@ def _box_blur(a, radius):
     """separable box blur, run twice so the ramp is a smooth triangular one"""
     if radius < 1:
         return a
+    k = 2 * radius + 1
     for _ in range(2):
         for axis in (0, 1):
             a = np.swapaxes(a, 0, axis)
             pad = np.pad(a, ((radius + 1, radius), (0, 0)), mode="edge")
-            cs = np.cumsum(pad, axis=0, dtype=np.float32)
-            a = (cs[2 * radius + 1 :] - cs[: -(2 * radius + 1)]) / (2 * radius + 1)
+            # running sums in place, the padded copy is not needed afterwards
+            cs = np.cumsum(pad, axis=0, dtype=np.float32, out=pad)
+            a = np.subtract(cs[k:], cs[:-k])
+            a /= k
             a = np.swapaxes(a, 0, axis)
     return a
 
 
+def _feather(valid, radius):
+    """
+    The weight a source fades in with: its blurred validity mask, cut to where
+    it is valid. Two box passes reach 2*radius pixels, so past that distance
+    from its invalid pixels the weight is exactly 1, and only the box around
+    them (plus what the blur reads of its surroundings) is blurred. Interior
+    macrotiles of a source have nothing to blur at all.
+    """
+    weight = valid.astype(np.float32)
+    if radius < 1:
+        return weight
+    h, w = valid.shape
+    rows = np.flatnonzero(~valid.all(axis=1))
+    cols = np.flatnonzero(~valid.all(axis=0))
+    reach = 2 * radius
+    r0, r1 = max(rows[0] - reach, 0), min(rows[-1] + reach + 1, h)
+    c0, c1 = max(cols[0] - reach, 0), min(cols[-1] + reach + 1, w)
+    R0, R1 = max(r0 - reach, 0), min(r1 + reach, h)
+    C0, C1 = max(c0 - reach, 0), min(c1 + reach, w)
+    blurred = _box_blur(weight[R0:R1, C0:C1], radius)
+    weight[r0:r1, c0:c1] *= blurred[r0 - R0 : r1 - R0, c0 - C0 : c1 - C0]
+    return weight
+
+
 def source_resolution_m(src):
     """native resolution of a dataset, roughly in metres"""
     res = abs(src.transform.a)
@@ -381,45 +808,242 @@ def source_resolution_m(src):
     return res
 
 
+def to_mercator(lng, lat):
+    """lng/lat arrays to EPSG:3857 metres"""
+    lat = np.clip(lat, -85.0511287798, 85.0511287798)
+    x = np.radians(lng) * 6378137.0
+    y = np.log(np.tan(np.pi / 4.0 + np.radians(lat) / 2.0)) * 6378137.0
+    return x, y
+
+
+def _coverage_wkb(boxes):
+    """the union of wgs84 boxes, as wkb to travel to the workers with the spec"""
+    return shapely.wkb.dumps(unary_union([geometry.box(*b) for b in boxes]))
+
+
+def _load_coverage(path):
+    """a coverage polygon, from an osmosis .poly or a geojson, in wgs84"""
+    if path.endswith(".poly"):
+        return parse_poly(path)
+    js = json.load(open(path))
+    features = js["features"] if js.get("type") == "FeatureCollection" else [js]
+    return unary_union(
+        [geometry.shape(f["geometry"] if f.get("type") == "Feature" else f) for f in features]
+    )
+
+
 class Source(object):
     """
     A source, opened at the overview level closest to the resolution being asked
     for. Without this a 5m source is read at full resolution to fill a 50m tile
     grid, which is 100x the pixels needed.
+
+    It also knows its footprint: the bounds of the dataset, and when there is
+    one the polygon it actually covers, either `coverage` in the spec or the
+    boxes of the files the prepare step found. A national source has nothing to
+    give a macrotile across the border, and warping it would still cost a full
+    reproject of an empty window.
     """
 
     def __init__(self, spec):
         self.spec = spec
         self.path = spec["_path"]
         self._cache = {}
+        self._keys = None
         base = rasterio.open(self.path)
         self.base_res = source_resolution_m(base)
         self.overviews = base.overviews(1)
         self._cache[None] = base
+        self._footprint(
+            None
+            if base.crs is None
+            else transform_bounds(base.crs, "EPSG:4326", *base.bounds)
+        )
+
+    def _footprint(self, wgs84_bounds):
+        spec = self.spec
+        self.bounds = None
+        self.coverage = None
+        if wgs84_bounds is None:
+            return
+        w, s, e, n = wgs84_bounds
+        (x0, x1), (y0, y1) = to_mercator(np.array([w, e]), np.array([s, n]))
+        # a couple of source pixels, bilinear reads one past the edge
+        lat = math.radians(min(85.0, max(abs(s), abs(n))))
+        margin = 2 * self.base_res / math.cos(lat)
+        self.bounds = (x0 - margin, y0 - margin, x1 + margin, y1 + margin)
+        if spec.get("coverage"):
+            coverage = _load_coverage(spec["coverage"])
+        elif spec.get("_coverage"):
+            coverage = shapely.wkb.loads(spec["_coverage"])
+        else:
+            coverage = None
+        if coverage is not None:
+            coverage = shapely.transform(
+                coverage, lambda c: np.column_stack(to_mercator(c[:, 0], c[:, 1]))
+            )
+            self.coverage = prep(coverage.buffer(margin))
+
+    def touches(self, window):
+        """whether the footprint touches a w, s, e, n window in EPSG:3857"""
+        if self.bounds is None:
+            return True
+        if not _intersects(self.bounds, window):
+            return False
+        return self.coverage is None or self.coverage.intersects(geometry.box(*window))
+
+    def key(self, window):
+        """
+        What a block over a w, s, e, n window in EPSG:3857 takes from this
+        source: its spec, and the files under the window with their mtime and
+        size. The files of unknown extent are under every window
+        """
+        if self._keys is None:
+            spec = {k: v for k, v in self.spec.items() if not k.startswith("_")}
+            spec.pop("allow_full_download", None)
+            spec.pop("download", None)
+            files = self.spec.get("_files") or [(self.path, 0, 0, None)]
+            boxed = [f[:3] for f in files if f[3] is not None]
+            always = [f[:3] for f in files if f[3] is None]
+            head = hashlib.sha1(json.dumps([spec, always], sort_keys=True).encode()).hexdigest()
+            tree = None
+            if boxed:
+                b = np.array([f[3] for f in files if f[3] is not None], dtype=np.float64)
+                x0, y0 = to_mercator(b[:, 0], b[:, 1])
+                x1, y1 = to_mercator(b[:, 2], b[:, 3])
+                # bilinear reads a pixel past the edge, as for the footprint
+                lat = np.radians(np.minimum(85.0, np.maximum(abs(b[:, 1]), abs(b[:, 3]))))
+                m = 2 * self.base_res / np.cos(lat)
+                tree = shapely.STRtree(shapely.box(x0 - m, y0 - m, x1 + m, y1 + m))
+            self._keys = head, boxed, tree
+        head, boxed, tree = self._keys
+        under = [] if tree is None else sorted(tree.query(geometry.box(*window)))
+        return [head, [boxed[i] for i in under]]
 
     def at(self, target_res_m):
-        level = None
-        if self.overviews and target_res_m > self.base_res:
-            ratio = target_res_m / self.base_res
-            usable = [i for i, f in enumerate(self.overviews) if f <= ratio]
-            if usable:
-                level = usable[-1]
+        level = _overview_level(self.overviews, self.base_res, target_res_m)
         if level not in self._cache:
             self._cache[level] = rasterio.open(self.path, overview_level=level)
         return self._cache[level]
 
+    def warp(self, shape, dst_transform, target_res_m, nodata_out):
+        out = np.full(shape, nodata_out, dtype=np.float32)
+        reproject(
+            rasterio.band(self.at(target_res_m), 1),
+            out,
+            dst_transform=dst_transform,
+            dst_crs="EPSG:3857",
+            dst_nodata=nodata_out,
+            resampling=Resampling.bilinear,
+        )
+        return out
 
-def _warp_source(src, shape, dst_transform, nodata_out):
-    out = np.full(shape, nodata_out, dtype=np.float32)
-    reproject(
-        rasterio.band(src, 1),
-        out,
-        dst_transform=dst_transform,
-        dst_crs="EPSG:3857",
-        dst_nodata=nodata_out,
-        resampling=Resampling.bilinear,
-    )
-    return out
+
+class IndexedSource(Source):
+    """
+    A source of many files read through the R-tree of `_file_index`: each block
+    opens only the files under it, each at its own overview level, and mosaics
+    them the way a vrt would before warping. The footprint is the R-tree itself.
+    """
+
+    # datasets kept open per worker, neighbouring blocks share most files
+    OPEN_FILES = 64
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.path = spec["_path"]
+        self._keys = None
+        self.index = sqlite3.connect("file:%s?mode=ro" % self.path, uri=True)
+        meta = dict(self.index.execute("SELECT name, value FROM meta"))
+        self.base_res = float(meta["resolution"])
+        self.crs = meta["crs"] or None
+        self._open = collections.OrderedDict()
+        self._footprint(json.loads(meta["bounds"]))
+
+    def files(self, window):
+        w, s, e, n = window
+        return [
+            row[0]
+            for row in self.index.execute(
+                "SELECT files.path FROM files_rtree JOIN files ON files.id = files_rtree.id "
+                "WHERE files_rtree.minx <= ? AND files_rtree.maxx >= ? "
+                "AND files_rtree.miny <= ? AND files_rtree.maxy >= ? ORDER BY files.id",
+                (e, w, n, s),
+            )
+        ]
+
+    def touches(self, window):
+        return Source.touches(self, window) and bool(self.files(window))
+
+    def _dataset(self, path, level=None):
+        key = (path, level)
+        if key in self._open:
+            self._open.move_to_end(key)
+            return self._open[key]
+        src = rasterio.open(path, overview_level=level)
+        self._open[key] = src
+        while len(self._open) > self.OPEN_FILES:
+            self._open.popitem(last=False)[1].close()
+        return src
+
+    def warp(self, shape, dst_transform, target_res_m, nodata_out):
+        out = np.full(shape, nodata_out, dtype=np.float32)
+        west, north = dst_transform.c, dst_transform.f
+        east = west + shape[1] * dst_transform.a
+        south = north + shape[0] * dst_transform.e
+        files = []
+        for path in self.files((west, south, east, north)):
+            base = self._dataset(path)
+            level = _overview_level(base.overviews(1), self.base_res, target_res_m)
+            files.append(base if level is None else self._dataset(path, level))
+        if not files:
+            return out
+        # mosaic the files in their own crs first: warped one by one, bilinear
+        # would clamp at every file edge and leave a seam along it
+        crs = files[0].crs or self.crs
+        xres, yres = files[0].res
+        w, s, e, n = transform_bounds("EPSG:3857", crs, west, south, east, north)
+        # on the grid of the files, or merge would shift them by up to a pixel
+        x0, y0 = files[0].transform.c, files[0].transform.f
+        w = x0 + (math.floor((w - x0) / xres) - 2) * xres
+        e = x0 + (math.ceil((e - x0) / xres) + 2) * xres
+        s = y0 + (math.floor((s - y0) / yres) - 2) * yres
+        n = y0 + (math.ceil((n - y0) / yres) + 2) * yres
+        mosaic, transform = merge(
+            files,
+            bounds=(w, s, e, n),
+            res=(xres, yres),
+            nodata=nodata_out,
+            dtype="float32",
+            indexes=[1],
+        )
+        reproject(
+            mosaic[0],
+            out,
+            src_transform=transform,
+            src_crs=crs,
+            src_nodata=nodata_out,
+            dst_transform=dst_transform,
+            dst_crs="EPSG:3857",
+            dst_nodata=nodata_out,
+            resampling=Resampling.bilinear,
+        )
+        return out
+
+
+def open_source(spec):
+    return IndexedSource(spec) if spec.get("_index") else Source(spec)
+
+
+def _overview_level(overviews, base_res, target_res_m):
+    """the coarsest overview still finer than the target resolution"""
+    level = None
+    if overviews and target_res_m > base_res:
+        ratio = target_res_m / base_res
+        usable = [i for i, f in enumerate(overviews) if f <= ratio]
+        if usable:
+            level = usable[-1]
+    return level
 
 
 def composite(sources, shape, dst_transform, blur_px, nodata_elev, target_res_m):
@@ -432,7 +1056,8 @@ def composite(sources, shape, dst_transform, blur_px, nodata_elev, target_res_m)
     out = None
     for source in sources:
         spec = source.spec
-        arr = _warp_source(source.at(target_res_m), shape, dst_transform, SENTINEL)
+        with stage("warp", source=spec["name"]):
+            arr = source.warp(shape, dst_transform, target_res_m, SENTINEL)
         valid = arr != SENTINEL
         if not valid.any():
             continue
@@ -442,9 +1067,12 @@ def composite(sources, shape, dst_transform, blur_px, nodata_elev, target_res_m)
         if out is None:
             out = np.where(valid, arr, np.float32(nodata_elev))
             continue
-        weight = valid.astype(np.float32)
-        if blur_px >= 1:
-            weight = _box_blur(weight, int(blur_px)) * weight
+        if valid.all():
+            # the whole block is inside the source, it wins everywhere
+            out = arr
+            continue
+        with stage("blur", source=spec["name"]):
+            weight = _feather(valid, int(blur_px))
         out = out * (1.0 - weight) + np.where(valid, arr, out) * weight
     if out is None:
         out = np.full(shape, nodata_elev, dtype=np.float32)
@@ -456,33 +1084,252 @@ def composite(sources, shape, dst_transform, blur_px, nodata_elev, target_res_m)
 # --------------------------------------------------------------------------
 
 
-def tiles_for_zoom(geom, bbox, zoom, tile_buffer):
-    """every tile whose extent, grown by tile_buffer tiles, touches the shape"""
+def _tile_boxes(xs, ys, zoom, tile_buffer):
+    """lng/lat bounds of tiles, as mercantile.bounds, grown by tile_buffer tiles"""
+    n = 2.0 ** zoom
+    w = xs / n * 360.0 - 180.0
+    e = (xs + 1) / n * 360.0 - 180.0
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ys / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (ys + 1) / n))))
+    if tile_buffer:
+        dx, dy = (e - w) * tile_buffer, (north - south) * tile_buffer
+        w, e, south, north = w - dx, e + dx, south - dy, north + dy
+    return w, south, e, north
+
+
+def select_tiles(geom, bbox, minzoom, maxzoom, tile_buffer):
+    """
+    Every tile whose extent, grown by tile_buffer tiles, touches the shape, for
+    each zoom from minzoom to maxzoom, as TileSets.
+
+    The quadtree is walked down from minzoom: a tile that misses the shape has no
+    descendant touching it, a tile inside the shape has all of them, so only the
+    tiles on its boundary are tested at the next zoom, all at once with shapely's
+    vectorized predicates. A country at z14 is a perimeter of tiles, not the
+    millions of its bounding box.
+    """
     w, s, e, n = bbox
-    max_index = 2 ** zoom - 1
-    ul = mercantile.tile(w + 1e-10, min(n - 1e-10, 85.0), zoom)
-    lr = mercantile.tile(e - 1e-10, max(s + 1e-10, -85.0), zoom)
-    out = []
-    for x in range(max(0, ul.x - tile_buffer), min(max_index, lr.x + tile_buffer) + 1):
-        for y in range(
-            max(0, ul.y - tile_buffer), min(max_index, lr.y + tile_buffer) + 1
-        ):
-            tw, ts, te, tn = mercantile.bounds(x, y, zoom)
-            if tile_buffer:
-                dx, dy = (te - tw) * tile_buffer, (tn - ts) * tile_buffer
-                tw, te, ts, tn = tw - dx, te + dx, ts - dy, tn + dy
-            if geom is None or geometry.box(tw, ts, te, tn).intersects(geom):
-                out.append((x, y, zoom))
+    windows = {}
+    for z in range(minzoom, maxzoom + 1):
+        max_index = 2 ** z - 1
+        ul = mercantile.tile(w + 1e-10, min(n - 1e-10, 85.0), z)
+        lr = mercantile.tile(e - 1e-10, max(s + 1e-10, -85.0), z)
+        windows[z] = (
+            max(0, ul.x - tile_buffer),
+            max(0, ul.y - tile_buffer),
+            min(max_index, lr.x + tile_buffer),
+            min(max_index, lr.y + tile_buffer),
+        )
+    if geom is None:
+        return {
+            z: TileSet(z, x0, y0, np.ones((y1 - y0 + 1, x1 - x0 + 1), dtype=bool))
+            for z, (x0, y0, x1, y1) in windows.items()
+        }
+
+    shapely.prepare(geom)
+    x0, y0, x1, y1 = windows[minzoom]
+    ys, xs = np.mgrid[y0 : y1 + 1, x0 : x1 + 1]
+    xs, ys = xs.ravel(), ys.ravel()
+    # tiles fully inside the shape, and below minzoom their descendants. these
+    # are inside the bbox, so inside every window
+    inside = TileSet(minzoom)
+    out = {}
+    for z in range(minzoom, maxzoom + 1):
+        x0, y0, x1, y1 = windows[z]
+        keep = (xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)
+        xs, ys = xs[keep], ys[keep]
+        hit = shapely.intersects(geom, shapely.box(*_tile_boxes(xs, ys, z, tile_buffer)))
+        xs, ys = xs[hit], ys[hit]
+        full = shapely.contains(geom, shapely.box(*_tile_boxes(xs, ys, z, 0)))
+        inside = inside | TileSet.from_xy(z, xs[full], ys[full])
+        xs, ys = xs[~full], ys[~full]
+        out[z] = inside | TileSet.from_xy(z, xs, ys)
+        if z == maxzoom:
+            break
+        inside = inside.children()
+        xs = (xs[:, None] * 2 + np.array([0, 1, 0, 1])).ravel()
+        ys = (ys[:, None] * 2 + np.array([0, 0, 1, 1])).ravel()
     return out
 
 
+def zorder(tile):
+    """rank of a tile along the z-order curve, the 4 children of a tile are consecutive"""
+    x, y, z = tile
+    key = 0
+    for i in range(z):
+        key |= ((x >> i) & 1) << (2 * i) | ((y >> i) & 1) << (2 * i + 1)
+    return key
+
+
+class TileSet(object):
+    """
+    The tiles of one zoom, as a bitmap over their bounding window. Membership,
+    iteration and the mapping to parents and children go through numpy, not a
+    tuple per tile: a z14 selection over the Alps is a few MB instead of
+    millions of python objects, and is cheap to hand to the workers.
+    Iteration is sorted like the tuples would be, x then y.
+    """
+
+    def __init__(self, zoom, x0=0, y0=0, mask=None):
+        self.zoom = zoom
+        self.x0 = x0
+        self.y0 = y0
+        self.mask = np.zeros((0, 0), dtype=bool) if mask is None else mask
+
+    @classmethod
+    def from_xy(cls, zoom, xs, ys):
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        if not xs.size:
+            return cls(zoom)
+        x0, y0 = int(xs.min()), int(ys.min())
+        mask = np.zeros((int(ys.max()) - y0 + 1, int(xs.max()) - x0 + 1), dtype=bool)
+        mask[ys - y0, xs - x0] = True
+        return cls(zoom, x0, y0, mask)
+
+    @classmethod
+    def from_tiles(cls, zoom, tiles):
+        tiles = list(tiles)
+        return cls.from_xy(zoom, [t[0] for t in tiles], [t[1] for t in tiles])
+
+    def xy(self):
+        """x and y arrays of the tiles, in iteration order"""
+        xs, ys = np.nonzero(self.mask.T)
+        return xs + self.x0, ys + self.y0
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask))
+
+    def __iter__(self):
+        xs, ys = self.xy()
+        z = self.zoom
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            yield x, y, z
+
+    def __contains__(self, tile):
+        x, y, z = tile
+        if z != self.zoom:
+            return False
+        x -= self.x0
+        y -= self.y0
+        h, w = self.mask.shape
+        return 0 <= x < w and 0 <= y < h and bool(self.mask[y, x])
+
+    def __or__(self, other):
+        if not len(other):
+            return self
+        if not len(self):
+            return other
+        x0, y0 = min(self.x0, other.x0), min(self.y0, other.y0)
+        x1 = max(self.x0 + self.mask.shape[1], other.x0 + other.mask.shape[1])
+        y1 = max(self.y0 + self.mask.shape[0], other.y0 + other.mask.shape[0])
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for t in (self, other):
+            h, w = t.mask.shape
+            mask[t.y0 - y0 : t.y0 - y0 + h, t.x0 - x0 : t.x0 - x0 + w] |= t.mask
+        return TileSet(self.zoom, x0, y0, mask)
+
+    def block(self, x, y, side):
+        """side x side bool array of the tiles from x/y, rows along y"""
+        out = np.zeros((side, side), dtype=bool)
+        h, w = self.mask.shape
+        bx0, by0 = max(x, self.x0), max(y, self.y0)
+        bx1, by1 = min(x + side, self.x0 + w), min(y + side, self.y0 + h)
+        if bx0 < bx1 and by0 < by1:
+            out[by0 - y : by1 - y, bx0 - x : bx1 - x] = self.mask[
+                by0 - self.y0 : by1 - self.y0, bx0 - self.x0 : bx1 - self.x0
+            ]
+        return out
+
+    def children(self):
+        """the 4 children of every tile, one zoom below"""
+        mask = self.mask.repeat(2, axis=0).repeat(2, axis=1)
+        return TileSet(self.zoom + 1, self.x0 * 2, self.y0 * 2, mask)
+
+    def parents(self, zoom):
+        """the tiles of `zoom` containing these"""
+        shift = self.zoom - zoom
+        xs, ys = self.xy()
+        return TileSet.from_xy(zoom, xs >> shift, ys >> shift)
+
+
+def downsample(elev):
+    """2x2 average: a block of tiles becomes the block of their parents"""
+    return 0.25 * (elev[0::2, 0::2] + elev[1::2, 0::2] + elev[0::2, 1::2] + elev[1::2, 1::2])
+
+
 def round_digits_for(zoom, maxzoom, round_digits, max_round_digits):
     return min(round_digits + (maxzoom - zoom), max_round_digits)
 
 
+# the latitude a --vertical-step ratio reads the ground resolution at, that of
+# bench/terrain_ratio.py. fixed, so that neighbouring areas get the same steps
+# and their shared tiles the same codes
+VERTICAL_STEP_LAT = 45.5
+
+
+def vertical_steps(spec, minzoom, maxzoom, tile_size):
+    """
+    --vertical-step as a step in metres per zoom. Either `z:step,...`, the
+    zooms not given taking the step of the closest one given, doubled per zoom
+    out, or a ratio R: the ground resolution at VERTICAL_STEP_LAT over R,
+    snapped to a power of two, as in bench/terrain_ratio.py (26.8 with 512px
+    tiles is what mapterhorn ships, 2^(19-z)/256 at every latitude)
+    """
+    steps = {}
+    if ":" in spec:
+        given = {}
+        for item in spec.split(","):
+            z, step = item.split(":")
+            given[int(z)] = float(step)
+            if not given[int(z)] > 0:
+                raise ValueError("a step has to be above 0")
+        for z in range(minzoom, maxzoom + 1):
+            near = min(given, key=lambda g: (abs(g - z), g))
+            steps[z] = given[near] * 2.0 ** (near - z)
+    else:
+        ratio = float(spec)
+        if not ratio > 0:
+            raise ValueError("the ratio has to be above 0")
+        for z in range(minzoom, maxzoom + 1):
+            res = 2 * math.pi * 6378137.0 * math.cos(math.radians(VERTICAL_STEP_LAT)) / 2 ** z / tile_size
+            steps[z] = 2.0 ** round(math.log2(res / ratio))
+    return steps
+
+
+def round_digits_for_step(step, interval):
+    """the largest power of two multiple of the interval that is not above `step`"""
+    return min(23, max(0, int(math.floor(math.log2(step / interval) + 1e-9))))
+
+
 def encode(elev, base, interval, round_digits, fmt):
-    rgb = data_to_rgb(elev.astype(np.float64), base, interval, round_digits)
-    im = Image.fromarray(np.rollaxis(rgb, 0, 3))
+    """
+    Elevation to the 24 bit code (elev - base) / interval, snapped to the
+    nearest multiple of 2^round_digits, packed into R, G, B.
+
+    The code is worked out in float64, as data_to_rgb did: past 2^23 a
+    float32 has no fraction left to round (terrarium codes sit there), and
+    scaling in float32 moves the mapbox codes near a half step to the other
+    side of it. Then it is int32 down to the bytes.
+    """
+    step = 1 << round_digits
+    code = elev.astype(np.float64)
+    code -= base
+    code /= interval * step
+    code += 0.5
+    np.floor(code, out=code)
+    np.clip(code, 0, 0xFFFFFF >> round_digits, out=code)
+    q = code.astype(np.int32)
+    q <<= round_digits
+
+    rgb = np.empty(q.shape + (3,), dtype=np.uint8)
+    rgb[:, :, 2] = q & 0xFF
+    q >>= 8
+    rgb[:, :, 1] = q & 0xFF
+    q >>= 8
+    rgb[:, :, 0] = q
+    # the mode follows from the dtype and shape, passing it is deprecated
+    im = Image.fromarray(rgb)
     buf = io.BytesIO()
     if fmt == "webp":
         im.save(buf, format="webp", lossless=True)
@@ -492,18 +1339,189 @@ def encode(elev, base, interval, round_digits, fmt):
 
 
 def decode(blob, base, interval):
-    arr = np.asarray(Image.open(io.BytesIO(blob)).convert("RGB"), dtype=np.float64)
-    r, g, b = arr[:, :, 0], arr[:, :, 1], arr[:, :, 2]
-    return base + (r * 65536.0 + g * 256.0 + b) * interval
+    """float32 elevation of an encoded tile"""
+    rgb = np.asarray(Image.open(io.BytesIO(blob)).convert("RGB"))
+    code = rgb[:, :, 0].astype(np.int32) << 16
+    code |= rgb[:, :, 1].astype(np.int32) << 8
+    code |= rgb[:, :, 2]
+    elev = code.astype(np.float32)
+    elev *= np.float32(interval)
+    elev += np.float32(base)
+    return elev
+
+
+def hillshade(win, north, res, azimuth, altitude, z_factor):
+    """
+    8 bit shaded relief of a tile, `win` being its elevation and one pixel
+    around it, in EPSG:3857 with `res` metres pixels from `north` down. The
+    slopes are central differences over ground metres, res * cos(lat) row by
+    row, and the light comes from `azimuth` degrees clockwise from north,
+    `altitude` degrees above the horizon: a flat tile is 255 * sin(altitude)
+    """
+    rows = win.shape[0] - 2
+    y = north - (np.arange(rows) + 0.5) * res
+    lat = 2 * np.arctan(np.exp(y / 6378137.0)) - math.pi / 2
+    step = (2 * res * np.cos(lat)).astype(np.float32)[:, None] / np.float32(z_factor)
+    # the surface normal is (-dz/dx, -dz/dy, 1) with x east and y north
+    nx = (win[1:-1, :-2] - win[1:-1, 2:]) / step
+    ny = (win[2:, 1:-1] - win[:-2, 1:-1]) / step
+    az, alt = math.radians(azimuth), math.radians(altitude)
+    shade = nx * np.float32(math.sin(az) * math.cos(alt))
+    shade += ny * np.float32(math.cos(az) * math.cos(alt))
+    shade += np.float32(math.sin(alt))
+    shade /= np.sqrt(nx * nx + ny * ny + 1)
+    shade *= 255
+    np.clip(shade, 0, 255, out=shade)
+    return np.rint(shade).astype(np.uint8)
+
+
+def _shrink_avail(avail, ring):
+    """
+    the tiles of a block and of its ring that are there, as in _macro_worker,
+    one zoom down: a tile is there when its 4 children are, a side of the
+    ring when both halves of it are, a corner when it was. None of the ring
+    once it is gone
+    """
+    core = avail[1:-1, 1:-1]
+    n = core.shape[0] // 2
+    out = np.zeros((n + 2, n + 2), dtype=bool)
+    out[1:-1, 1:-1] = core[0::2, 0::2] & core[1::2, 0::2] & core[0::2, 1::2] & core[1::2, 1::2]
+    if ring:
+        for i in (0, -1):
+            out[i, 1:-1] = avail[i, 1:-1:2] & avail[i, 2:-1:2]
+            out[1:-1, i] = avail[1:-1:2, i] & avail[2:-1:2, i]
+            out[i, [0, -1]] = avail[i, [0, -1]]
+    return out
+
+
+def _tile_window(elev, avail, tx, ty, ts, ring):
+    """
+    tile tx/ty of the block `elev` with a pixel of its neighbours around it,
+    for `hillshade` and `trace_contours`: from the tiles next to it where they
+    are there, in the block or in the `ring` of pixels around it, otherwise
+    its own edge repeated, a one sided slope. `avail` is that of _macro_worker
+    """
+    y0, x0 = ring + ty * ts, ring + tx * ts
+    win = np.empty((ts + 2, ts + 2), dtype=np.float32)
+    win[1:-1, 1:-1] = elev[y0 : y0 + ts, x0 : x0 + ts]
+
+    def there(dx, dy):
+        return bool(avail[ty + dy + 1, tx + dx + 1])
+
+    win[0, 1:-1] = elev[y0 - 1, x0 : x0 + ts] if there(0, -1) else win[1, 1:-1]
+    win[-1, 1:-1] = elev[y0 + ts, x0 : x0 + ts] if there(0, 1) else win[-2, 1:-1]
+    win[1:-1, 0] = elev[y0 : y0 + ts, x0 - 1] if there(-1, 0) else win[1:-1, 1]
+    win[1:-1, -1] = elev[y0 : y0 + ts, x0 + ts] if there(1, 0) else win[1:-1, -2]
+    # a missing corner repeats the edge that is missing next to it, as the
+    # tiles around it do, so that they all see the same corner
+    for dx, dy in ((-1, -1), (1, -1), (-1, 1), (1, 1)):
+        r, c = (0 if dy < 0 else -1), (0 if dx < 0 else -1)
+        if there(dx, dy):
+            win[r, c] = elev[y0 - 1 if dy < 0 else y0 + ts, x0 - 1 if dx < 0 else x0 + ts]
+        elif not there(dx, 0):
+            win[r, c] = win[r, c - dx]
+        else:
+            win[r, c] = win[r - dy, c]
+    return win
+
+
+def encode_shade(shade, fmt):
+    """a grey hillshade tile"""
+    im = Image.fromarray(shade)
+    buf = io.BytesIO()
+    if fmt == "webp":
+        im.save(buf, format="webp", lossless=True)
+    else:
+        im.save(buf, format="png")
+    return buf.getvalue()
+
+
+# bumped whenever composite changes its output, the cached blocks are then stale
+BLOCK_CACHE_VERSION = 1
+
+
+class BlockCache(object):
+    """
+    Composited float32 blocks on disk, shared by the builds of every area made
+    from the same sources: a block is keyed by what it is made of, so the
+    macrotiles along a border are warped once, and come out identical on both
+    sides of it. Past `cap` bytes the least recently used go first: a hit bumps
+    the mtime of its file, and `evict` runs from the main process.
+    """
+
+    def __init__(self, root, cap):
+        self.root = root
+        self.cap = cap
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npy")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            elev = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return elev
+
+    def put(self, key, elev):
+        """written aside then renamed, workers and builds share the directory"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            np.save(f, elev)
+        os.replace(tmp, path)
+
+    def evict(self):
+        """drop the least recently used blocks past the cap, returns the bytes and
+        blocks kept, and the blocks dropped"""
+        entries = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith(".npy"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        size = kept = dropped = 0
+        for _, n, path in sorted(entries, reverse=True):
+            if size + n > self.cap:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                dropped += 1
+            else:
+                size += n
+                kept += 1
+        return size, kept, dropped
 
 
 def _init_worker(specs, args):
-    WORKER["sources"] = [Source(s) for s in specs]
+    if args.get("profile") and PROFILE["events"] is None:
+        PROFILE["events"] = []
+    WORKER["sources"] = []
+    for spec in specs:
+        with stage("open", source=spec["name"]):
+            WORKER["sources"].append(open_source(spec))
     WORKER["args"] = args
+    WORKER["cache"] = None
+    if args.get("block_cache"):
+        WORKER["cache"] = BlockCache(args["block_cache"], args["block_cache_size"])
 
 
-def warp_block(sources, a, mx, my, mz, zoom):
-    """composite the area of tile mx/my/mz, at the resolution of `zoom`"""
+def warp_block(sources, a, mx, my, mz, zoom, counts=None, ring=0):
+    """
+    composite the area of tile mx/my/mz, at the resolution of `zoom`, and
+    `ring` pixels of the halo around it. With a block cache, the block is
+    looked up there first, keyed by the files under its window and every
+    parameter of the composite
+    """
     tiles_side = 2 ** (zoom - mz)
     size = tiles_side * a["tile_size"]
     halo = a["halo"]
@@ -514,146 +1532,1581 @@ def warp_block(sources, a, mx, my, mz, zoom):
     dst_transform = riotransform.from_origin(
         west - halo * res, north + halo * res, res, res
     )
+    window = (west - halo * res, south - halo * res, east + halo * res, north + halo * res)
+    sources = [s for s in sources if s.touches(window)]
+
+    cache = WORKER.get("cache")
+    if cache is not None:
+        key = hashlib.sha1(
+            json.dumps(
+                [
+                    BLOCK_CACHE_VERSION,
+                    [s.key(window) for s in sources],
+                    a["blur"],
+                    a["tile_size"],
+                    a["nodata_elev"],
+                    halo,
+                    mx,
+                    my,
+                    mz,
+                    zoom,
+                ]
+                # only when kept, so that the blocks cached without one stay valid
+                + ([ring] if ring else [])
+            ).encode()
+        ).hexdigest()
+        elev = cache.get(key)
+        if elev is not None:
+            if counts is not None:
+                counts[(zoom, "cached")] += 1
+            return elev
 
     # a rough latitude correction: web mercator metres are not ground metres
     lat = math.radians(mercantile.bounds(mx, my, mz).north)
     ground_res = res * max(0.1, math.cos(lat))
     blur_px = a["blur"] / ground_res if a["blur"] else 0
 
-    elev = composite(
-        sources, (full, full), dst_transform, blur_px, a["nodata_elev"], ground_res
-    )
-    if halo:
-        elev = elev[halo : halo + size, halo : halo + size]
+    with stage("composite", zoom=zoom):
+        elev = composite(
+            sources, (full, full), dst_transform, blur_px, a["nodata_elev"], ground_res
+        )
+    if halo > ring:
+        elev = elev[halo - ring : halo + size + ring, halo - ring : halo + size + ring]
+    if cache is not None:
+        cache.put(key, elev)
     return elev
 
 
 def _macro_worker(job):
-    """warp one macrotile once, then slice it into max zoom tiles"""
-    mx, my, mz = job
+    """
+    One macrotile of the pyramid: `root` and every tile below it down to the
+    `bottom` zoom. At the first level the block is warped once at the max zoom;
+    below, it is assembled from the float32 roots of the level above, given in
+    `inputs`. The block is then averaged down to the root, which is returned
+    as float32 for the next level.
+
+    At the first level every tile of the block is there, wanted or not, and
+    the tiles past the edge of the selection are averaged like the others.
+    Below, a wanted tile whose children are not all there, a tile of the
+    buffer ring whose children are outside of the selection of the zoom below,
+    is warped straight from the dem: cheaper than widening every zoom down to
+    the max one.
+
+    Only the stored tiles are encoded. The helpers, wanted only to average the
+    zoom below, stay float32, except the root when it is one: it goes to the
+    scratch store in case the next level has to decode it back.
+
+    With --hillshade and --contours, the stored tiles are also shaded and
+    traced, from the elevation of their zoom and a pixel around each tile.
+    The max zoom block is warped with a ring of its halo, averaged down along
+    with it, and the roots carry what is left of it to the level below, which
+    puts the rings of its children together around its own block. The tiles
+    along the edges of a job then see their neighbours at every zoom, down
+    to the lowest one made, where the ring is a pixel wide. The contours of
+    the zooms past the max one are cut from the lines traced at the max zoom.
+
+    With --profile, the stages timed in the worker and its peak RSS come back
+    with the job.
+    """
+    root, bottom, inputs = job
+    rx, ry, rz = root
     a = WORKER["args"]
-    tiles_side = 2 ** (a["maxzoom"] - mz)
-    elev = warp_block(WORKER["sources"], a, mx, my, mz, a["maxzoom"])
+    if a.get("profile"):
+        _peak_rss(reset=True)
+    ts = a["tile_size"]
+    wanted = a["wanted"]
+    store = a["store"]
+    side = 2 ** (bottom - rz)
+    # the tiles of the block that are there, and around them, those of the
+    # ring: avail[ty + 1, tx + 1] for tile tx/ty of the block
+    avail = np.zeros((side + 2, side + 2), dtype=bool)
+    # (zoom, what) -> blocks re-warped, or read from the block cache
+    counts = collections.Counter()
+    light = a.get("hillshade")
+    contours = a.get("contours")
+    # pixels of the halo kept around the block at this zoom, for the windows
+    ring = a["ring"] >> (a["maxzoom"] - bottom)
+    if inputs is None:
+        first = bottom
+        if wanted[bottom].block(rx * side, ry * side, side).any():
+            big = warp_block(WORKER["sources"], a, rx, ry, rz, bottom, counts, ring)
+            avail[1:-1, 1:-1] = True
+            avail[[0, -1], :] = avail[:, [0, -1]] = ring > 0
+        else:
+            big = np.zeros((side * ts + 2 * ring,) * 2, dtype=np.float32)
+    else:
+        first = bottom - 1
+        big = np.zeros((side * ts + 2 * ring,) * 2, dtype=np.float32)
+        # the rings of the children on the edges first, their tiles over them
+        for (x, y, _), child in inputs.items():
+            tx, ty = x - rx * side, y - ry * side
+            edge = not (0 < tx < side - 1 and 0 < ty < side - 1)
+            if ring and edge and child.shape[0] == ts + 2 * ring:
+                big[ty * ts : (ty + 1) * ts + 2 * ring, tx * ts : (tx + 1) * ts + 2 * ring] = child
+                for dx, dy in np.ndindex(3, 3):
+                    cx, cy = tx + dx - 1, ty + dy - 1
+                    # the side of the ring next to it, or a corner of the ring,
+                    # are all this child's. not those next to its neighbours
+                    if (dx == 1 or cx in (-1, side)) and (dy == 1 or cy in (-1, side)):
+                        avail[cy + 1, cx + 1] = True
+        for (x, y, _), child in inputs.items():
+            tx, ty = x - rx * side, y - ry * side
+            r = (child.shape[0] - ts) // 2
+            y0, x0 = ring + ty * ts, ring + tx * ts
+            big[y0 : y0 + ts, x0 : x0 + ts] = child[r : r + ts, r : r + ts]
+            avail[ty + 1, tx + 1] = True
+    elev = big[ring : big.shape[0] - ring, ring : big.shape[1] - ring]
 
     base, interval = ENCODINGS[a["encoding"]]
-    rd = round_digits_for(a["maxzoom"], a["maxzoom"], a["round_digits"], a["max_round_digits"])
     out = []
-    for ty in range(tiles_side):
-        for tx in range(tiles_side):
-            sub = elev[
-                ty * a["tile_size"] : (ty + 1) * a["tile_size"],
-                tx * a["tile_size"] : (tx + 1) * a["tile_size"],
-            ]
-            x = mx * tiles_side + tx
-            y = my * tiles_side + ty
-            if (x, y, a["maxzoom"]) not in a["wanted"]:
-                continue
-            out.append(((x, y, a["maxzoom"]), encode(sub, base, interval, rd, a["format"])))
-    return out
+    helpers = []
+    extras = {"hillshade": [], "contours": []}
+    for z in range(bottom, rz - 1, -1):
+        if z < bottom:
+            with stage("downsample", zoom=z):
+                if ring > 1:
+                    big = downsample(big)
+                    ring //= 2
+                    elev = big[ring : big.shape[0] - ring, ring : big.shape[1] - ring]
+                else:
+                    elev = big = downsample(elev)
+                    ring = 0
+            avail = _shrink_avail(avail, ring > 0)
+        if z > first:
+            continue
+        n = 2 ** (z - rz)
+        rd = a["round_digits"][z]
+        stored = len(out)
+        for ty in range(n):
+            for tx in range(n):
+                tile = (rx * n + tx, ry * n + ty, z)
+                if tile not in wanted.get(z, ()):
+                    continue
+                sub = elev[ty * ts : (ty + 1) * ts, tx * ts : (tx + 1) * ts]
+                if not avail[ty + 1, tx + 1]:
+                    sub[:] = warp_block(WORKER["sources"], a, tile[0], tile[1], z, z, counts)
+                    avail[ty + 1, tx + 1] = True
+                    counts[(z, "re-warped")] += 1
+                if tile in store[z] or tile == root:
+                    with stage("encode", zoom=z):
+                        blob = encode(sub, base, interval, rd, a["format"])
+                    (out if tile in store[z] else helpers).append((tile, blob))
+        traced = contours and contours[0] <= z <= contours[1]
+        if not light and not traced:
+            continue
+        # once the whole zoom is there, re-warped tiles included: they are the
+        # neighbours of the others
+        for tile, _ in out[stored:]:
+            win = _tile_window(big, avail, tile[0] - rx * n, tile[1] - ry * n, ts, ring)
+            if light:
+                west, _, east, north = mercantile.xy_bounds(*tile)
+                with stage("hillshade", zoom=z):
+                    shade = hillshade(win, north, (east - west) / ts, *light)
+                    extras["hillshade"].append((tile, encode_shade(shade, a["format"])))
+            if traced:
+                with stage("contours", zoom=z):
+                    deepest = contours[1] if z == a["maxzoom"] else z
+                    extras["contours"] += _contour_tiles(win, tile, deepest, contours[2], ts)
+    profile = None
+    if a.get("profile"):
+        profile = {"events": _drain_profile(), "rss": _peak_rss()}
+    root_elev = None
+    if avail[1, 1]:
+        # with its ring when it is there all around, for the windows below
+        root_elev = big if ring and avail.all() else elev
+    return root, out, helpers, root_elev, counts, extras, profile
+
+
+def _contour_tiles(win, tile, deepest, interval, ts):
+    """
+    the contour tiles of a stored tile and of every tile under it down to the
+    `deepest` zoom, cut from the same lines
+    """
+    x, y, z = tile
+    lines = trace_contours(win, contour_step(deepest, interval))
+    tiles = []
+    for cz in range(z, deepest + 1):
+        n = 2 ** (cz - z)
+        size = ts / n
+        for cy in range(n):
+            for cx in range(n):
+                blob = encode_contours(lines, cz, (cx * size, cy * size, size), ts)
+                if blob is not None:
+                    tiles.append(((x * n + cx, y * n + cy, cz), blob))
+    return tiles
 
 
 # --------------------------------------------------------------------------
-# mbtiles
+# contours
 # --------------------------------------------------------------------------
 
+# the div classes and the per zoom filter of scripts/build_contours.sh: a line
+# gets the largest of these its elevation is a multiple of, 10 otherwise, and
+# a zoom only keeps the classes listed. None keeps them all
+CONTOUR_DIVS = (1000, 500, 250, 200, 100, 50, 20)
+CONTOUR_FILTER = (
+    (6, (1000,)),
+    (7, (1000, 500)),
+    (9, (1000, 250, 200)),
+    (12, (1000, 500, 250, 200, 100)),
+    (13, (1000, 500, 250, 200, 100, 50)),
+)
+# tippecanoe -S 3 in build_contours.sh: simplified to 3 units of the extent
+CONTOUR_EXTENT = 4096
+CONTOUR_SIMPLIFY = 3.0
+
+# marching squares. the corners of a cell above the level give the case,
+# tl 8, tr 4, br 2, bl 1, and each case the edges, top 0, right 1, bottom 2,
+# left 3, its segments join. the saddles 5 and 10 go by the cell centre:
+# above, the case + 16 cuts off the corners below, otherwise the ones above
+_SEGMENTS = {
+    1: ((3, 2),), 2: ((2, 1),), 3: ((3, 1),), 4: ((0, 1),),
+    5: ((0, 1), (3, 2)), 21: ((3, 0), (2, 1)),
+    6: ((0, 2),), 7: ((3, 0),), 8: ((3, 0),), 9: ((0, 2),),
+    10: ((3, 0), (2, 1)), 26: ((0, 1), (3, 2)),
+    11: ((0, 1),), 12: ((3, 1),), 13: ((2, 1),), 14: ((3, 2),),
+}
+_SEGMENT_EDGES = np.full((2, 2, 32), -1, dtype=np.int8)
+for _case, _segments in _SEGMENTS.items():
+    for _i, _edges in enumerate(_segments):
+        _SEGMENT_EDGES[_i, :, _case] = _edges
 
-def zxy_to_id(z, x, y):
-    return int((1 - pow(4, z)) / (1 - 4) + pow(2, z) * y + x)
 
+def contour_div(ele):
+    for div in CONTOUR_DIVS:
+        if ele % div == 0:
+            return div
+    return 10
 
-class MBTiles(object):
-    def __init__(self, path):
-        if os.path.exists(path):
-            os.unlink(path)
-        self.conn = sqlite3.connect(path)
-        cur = self.conn.cursor()
-        cur.execute("PRAGMA synchronous=OFF")
-        cur.execute("PRAGMA journal_mode=MEMORY")
-        cur.execute(
-            "CREATE TABLE tiles_data (tile_data_id integer primary key, tile_data blob);"
-        )
-        cur.execute(
-            "CREATE TABLE tiles_shallow (zoom_level integer, tile_column integer, "
-            "tile_row integer, tile_data_id integer, "
-            "primary key(zoom_level,tile_column,tile_row)) without rowid;"
-        )
-        cur.execute(
-            "CREATE VIEW tiles AS SELECT tiles_shallow.zoom_level as zoom_level, "
-            "tiles_shallow.tile_column as tile_column, "
-            "tiles_shallow.tile_row as tile_row, tiles_data.tile_data as tile_data "
-            "FROM tiles_shallow JOIN tiles_data on "
-            "tiles_shallow.tile_data_id = tiles_data.tile_data_id"
-        )
-        cur.execute("CREATE TABLE metadata (name text, value text);")
-        self.conn.commit()
 
-    def put(self, tile, blob):
-        x, y, z = tile
-        tile_id = zxy_to_id(z, x, y)
-        flipped = int(math.pow(2, z)) - y - 1
-        cur = self.conn.cursor()
-        cur.execute(
-            "INSERT OR REPLACE INTO tiles_data (tile_data_id, tile_data) VALUES (?, ?)",
-            (tile_id, sqlite3.Binary(blob)),
-        )
-        cur.execute(
-            "INSERT OR REPLACE INTO tiles_shallow "
-            "(zoom_level, tile_column, tile_row, tile_data_id) VALUES (?, ?, ?, ?)",
-            (z, x, flipped, tile_id),
-        )
+def contour_divs(zoom):
+    """the div classes drawn at `zoom`, None for all of them"""
+    for maxzoom, divs in CONTOUR_FILTER:
+        if zoom <= maxzoom:
+            return divs
+    return None
 
-    def get(self, tile):
-        x, y, z = tile
-        flipped = int(math.pow(2, z)) - y - 1
-        cur = self.conn.cursor()
-        cur.execute(
-            "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? "
-            "AND tile_row=?",
-            (z, x, flipped),
-        )
-        row = cur.fetchone()
-        return row[0] if row else None
 
-    def delete(self, tile):
-        x, y, z = tile
-        cur = self.conn.cursor()
-        cur.execute(
-            "DELETE FROM tiles_shallow WHERE zoom_level=? AND tile_column=? "
-            "AND tile_row=?",
-            (z, x, int(math.pow(2, z)) - y - 1),
-        )
-        cur.execute("DELETE FROM tiles_data WHERE tile_data_id=?", (zxy_to_id(z, x, y),))
+def contour_step(zoom, interval):
+    """every elevation drawn at `zoom` is a multiple of this"""
+    divs = contour_divs(zoom)
+    if divs is None:
+        return interval
+    step = 0
+    for div in divs:
+        step = math.gcd(step, div * interval // math.gcd(div, interval))
+    return step
 
-    def vacuum(self):
-        self.conn.commit()
-        self.conn.execute("VACUUM")
 
-    def metadata(self, items):
-        cur = self.conn.cursor()
-        for k, v in items.items():
-            cur.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", (k, str(v)))
-        self.conn.commit()
+def trace_contours(win, step):
+    """
+    The isolines of the multiples of `step` across the tile whose elevation,
+    and a pixel around it, is `win`: {elevation: MultiLineString} in pixels
+    of the tile from its top left corner, running half a pixel past its edges.
+
+    Marching squares between the pixel centres, every cell and level crossing
+    it at once. An edge is always interpolated from the same two pixels in
+    the same order, so the segments of neighbouring cells, and of neighbouring
+    tiles, meet exactly and are merged into lines by GEOS.
+    """
+    tl, tr, bl, br = win[:-1, :-1], win[:-1, 1:], win[1:, :-1], win[1:, 1:]
+    lo = np.minimum(np.minimum(tl, tr), np.minimum(bl, br))
+    hi = np.maximum(np.maximum(tl, tr), np.maximum(bl, br))
+    # the levels with lo < level <= hi, some corners are >= the level, some not
+    first = np.floor(lo / step).astype(np.int64).ravel() + 1
+    count = np.floor(hi / step).astype(np.int64).ravel() - first + 1
+    cells = np.flatnonzero(count > 0)
+    if not len(cells):
+        return {}
+    count = count[cells]
+    cell = np.repeat(cells, count)
+    start = np.repeat(np.cumsum(count) - count, count)
+    k = np.repeat(first[cells], count) + np.arange(len(cell)) - start
+
+    level = (k * step).astype(np.float64)
+    a, b, c, d = (x.ravel()[cell].astype(np.float64) for x in (tl, tr, br, bl))
+    case = (a >= level) * 8 + (b >= level) * 4 + (c >= level) * 2 + (d >= level) * 1
+    saddle = (case == 5) | (case == 10)
+    case[saddle & ((a + b + c + d) / 4 >= level)] += 16
+
+    i, j = np.divmod(cell, tl.shape[1])
+    # window pixel j, i is centred on tile pixel j - 0.5, i - 0.5
+    x, y = j - 0.5, i - 0.5
+    with np.errstate(divide="ignore", invalid="ignore"):
+        points = np.stack(
+            [
+                np.stack([x + (level - a) / (b - a), y], axis=-1),
+                np.stack([x + 1, y + (level - b) / (c - b)], axis=-1),
+                np.stack([x + (level - d) / (c - d), y + 1], axis=-1),
+                np.stack([x, y + (level - a) / (d - a)], axis=-1),
+            ],
+            axis=1,
+        )
+    segments, levels = [], []
+    for edges in _SEGMENT_EDGES:
+        e0, e1 = edges[0][case], edges[1][case]
+        there = np.flatnonzero(e0 >= 0)
+        segments.append(
+            np.stack([points[there, e0[there]], points[there, e1[there]]], axis=1)
+        )
+        levels.append(k[there])
+    segments = np.concatenate(segments)
+    levels = np.concatenate(levels)
 
-    def commit(self):
-        self.conn.commit()
+    order = np.argsort(levels, kind="stable")
+    levels, segments = levels[order], segments[order]
+    bounds = np.flatnonzero(np.diff(levels)) + 1
+    lines = {}
+    for part, level in zip(np.split(segments, bounds), levels[np.r_[0, bounds]]):
+        merged = shapely.line_merge(shapely.multilinestrings(shapely.linestrings(part)))
+        lines[int(level) * step] = merged
+    return lines
 
-    def close(self):
-        self.conn.commit()
-        self.conn.close()
 
+def _pbf(field, payload):
+    """a length delimited protobuf field"""
+    return bytes(_varints([field << 3 | 2, len(payload)])) + bytes(payload)
 
-# --------------------------------------------------------------------------
 
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
 
-def main():
-    p = argparse.ArgumentParser(description=__doc__)
-    p.add_argument("--sources", required=True, help="json file describing the sources")
-    p.add_argument("--poly-shape", help="osmosis .poly limiting the tiles")
-    p.add_argument("--bounds", help="w,s,e,n instead of --poly-shape")
-    p.add_argument("--minzoom", type=int, default=5)
-    p.add_argument("--maxzoom", type=int, default=12)
+
+def encode_contours(lines, zoom, box, ts):
+    """
+    The gzipped mvt of a tile, a `contour` layer with the `ele` and `div` of
+    every line drawn at `zoom`. `box` is x, y, size of the tile in pixels of
+    the `ts` pixels tile the lines were traced in, its own for the zooms of
+    the pyramid, the one of the max zoom it is under past it. None when empty
+    """
+    x0, y0, size = box
+    scale = CONTOUR_EXTENT / size
+    divs = contour_divs(zoom)
+    values = {}
+    features = []
+    for ele in sorted(lines):
+        div = contour_div(ele)
+        if divs is not None and div not in divs:
+            continue
+        geom = shapely.clip_by_rect(lines[ele], x0, y0, x0 + size, y0 + size)
+        geom = shapely.simplify(geom, CONTOUR_SIMPLIFY / scale)
+        cmds = []
+        cursor = np.zeros(2, dtype=np.int64)
+        for part in shapely.get_parts(geom):
+            if shapely.get_type_id(part) != 1:
+                continue
+            xy = np.rint((shapely.get_coordinates(part) - (x0, y0)) * scale).astype(np.int64)
+            xy = xy[np.r_[True, (np.diff(xy, axis=0) != 0).any(axis=1)]]
+            if len(xy) < 2:
+                continue
+            deltas = _zigzag(np.diff(xy, axis=0, prepend=[cursor]))
+            cursor = xy[-1]
+            cmds += [9, int(deltas[0, 0]), int(deltas[0, 1]), 2 | (len(xy) - 1) << 3]
+            cmds += deltas[1:].ravel().tolist()
+        if not cmds:
+            continue
+        tags = []
+        for key, value in ((0, ele), (1, div)):
+            tags += [key, values.setdefault(value, len(values))]
+        features.append(
+            _pbf(2, _varints(tags)) + bytes(_varints([3 << 3, 2])) + _pbf(4, _varints(cmds))
+        )
+    if not features:
+        return None
+    layer = bytes(_varints([15 << 3, 2])) + _pbf(1, b"contour")
+    layer += b"".join(_pbf(2, f) for f in features)
+    layer += _pbf(3, b"ele") + _pbf(3, b"div")
+    for value in values:
+        # uint_value, or sint_value below sea level
+        if value >= 0:
+            layer += _pbf(4, _varints([5 << 3, value]))
+        else:
+            layer += _pbf(4, _varints([6 << 3, (value << 1) ^ (value >> 63)]))
+    layer += bytes(_varints([5 << 3, CONTOUR_EXTENT]))
+    return gzip.compress(_pbf(3, layer), mtime=0)
+
+
+# --------------------------------------------------------------------------
+# pyramid
+# --------------------------------------------------------------------------
+
+
+def pyramid_levels(wanted, minzoom, maxzoom, macro_levels):
+    """
+    The jobs of each level of the pyramid, top to bottom of the zooms: first the
+    macrotiles warped at the max zoom, then macrotiles of the same depth built
+    from the roots of the level above, down to the min zoom. With
+    --macro-levels 0 the max zoom tiles are warped one by one, and each level
+    below is a zoom of its own.
+    Returns a list of (root zoom, bottom zoom, root tiles).
+    """
+    levels = []
+    bottom = maxzoom
+    above = set()
+    while True:
+        rz = max(0, bottom - macro_levels)
+        if levels:
+            rz = max(min(rz, bottom - 1), minzoom)
+        shift = bottom - rz
+        roots = {(x >> shift, y >> shift, rz) for x, y, _ in above}
+        for z in range(rz, bottom + (0 if levels else 1)):
+            if z in wanted:
+                roots.update(wanted[z].parents(rz))
+        levels.append((rz, bottom, roots))
+        if rz <= minzoom:
+            return levels
+        bottom, above = rz, roots
+
+
+def shard_levels(levels, wanted, shard, shards):
+    """
+    The part of the pyramid shard `shard` (from 0) of `shards` builds: a run of
+    the macrotiles in z-order, cut so that every shard gets about as many max
+    zoom tiles, then every job of the levels below whose macrotiles are all its
+    own. The rest, the jobs across the cuts, is left to the merge.
+    Returns those levels, and the frontier: the jobs whose parent is left to
+    the merge, their float32 root has to be kept for it.
+    """
+    rz, bottom, roots = levels[0]
+    side = 2 ** (bottom - rz)
+    first = sorted(roots, key=zorder)
+    # one per job on top of its tiles, a macrotile of the buffer ring costs too
+    weight = np.array(
+        [1 + int(wanted[bottom].block(x * side, y * side, side).sum()) for x, y, _ in first],
+        dtype=np.int64,
+    )
+    owner = ((np.cumsum(weight) - weight) * shards) // max(1, int(weight.sum()))
+    owned = [{job for job, o in zip(first, owner.tolist()) if o == shard}]
+    for (rz, bottom, roots), (_, _, above) in zip(levels[1:], levels):
+        shift = bottom - rz
+        children = collections.defaultdict(list)
+        for x, y, z in above:
+            children[(x >> shift, y >> shift, rz)].append((x, y, z))
+        owned.append(
+            {
+                job
+                for job in roots
+                if children[job] and all(c in owned[-1] for c in children[job])
+            }
+        )
+    frontier = set()
+    for (rz, bottom, roots), jobs, below in zip(levels[1:], owned[1:], owned):
+        shift = bottom - rz
+        frontier.update(t for t in below if (t[0] >> shift, t[1] >> shift, rz) not in jobs)
+    return [(rz, bottom, jobs) for (rz, bottom, _), jobs in zip(levels, owned)], frontier
+
+
+class Pyramid(object):
+    """
+    Hands out the jobs of `pyramid_levels` as they become ready: a job of a
+    lower level waits for the jobs above it, and is then given their float32
+    roots, so nothing is decoded back from the mbtiles.
+
+    The macrotiles are handed out in z-order, so siblings finish close to each
+    other and few roots wait at once. Past `cap` bytes the oldest ones are
+    dropped anyway, and `fallback` (a decode of the stored tile) is used if
+    they are needed after all. Roots of jobs done by an earlier run, when
+    resuming, come from `fallback` too: from the mbtiles, or from its scratch
+    store for the roots that are not output.
+    """
+
+    def __init__(self, levels, cap, fallback):
+        self.cap = cap
+        self.fallback = fallback
+        # the order the macrotiles go in, and a set to look them up
+        self.order = sorted(levels[0][2], key=zorder)
+        self.first = frozenset(self.order)
+        self.bottom = {}
+        self.parent = {}
+        self.children = collections.defaultdict(list)
+        for (rz, bottom, roots), below in zip(levels, [None] + levels[:-1]):
+            for root in roots:
+                self.bottom[root] = bottom
+            if below is None:
+                continue
+            shift = bottom - rz
+            for x, y, z in below[2]:
+                parent = (x >> shift, y >> shift, rz)
+                if parent not in roots:
+                    # a shard: left to the merge
+                    continue
+                self.parent[(x, y, z)] = parent
+                self.children[parent].append((x, y, z))
+        self.pending = {job: len(c) for job, c in self.children.items()}
+        # (parent, child) -> float32 root, in arrival order for eviction
+        self.buffer = collections.OrderedDict()
+        self.size = 0
+        self.evicted = 0
+        self.done = set()
+
+    def start(self, done=()):
+        """the jobs ready from the start, skipping those in `done`"""
+        self.done = set(done)
+        ready = []
+        lower = [j for j in self.bottom if j not in self.first and not self.children[j]]
+        for job in self.order + sorted(lower, key=lambda t: (-t[2], zorder(t))):
+            if job in self.done:
+                ready.extend(self.finish(job, None))
+            else:
+                ready.append(self._job(job))
+        return ready
+
+    def _job(self, job):
+        if job in self.first:
+            return job, self.bottom[job], None
+        inputs = {}
+        for child in self.children[job]:
+            elev = self.buffer.pop((job, child), None)
+            if elev is not None:
+                self.size -= elev.nbytes
+            else:
+                elev = self.fallback(child)
+            if elev is not None:
+                inputs[child] = elev
+        return job, self.bottom[job], inputs
+
+    def finish(self, job, elev):
+        """record a finished job and its root, returns the jobs this made ready"""
+        ready = []
+        todo = [(job, elev)]
+        while todo:
+            job, elev = todo.pop()
+            self.done.add(job)
+            parent = self.parent.get(job)
+            if parent is None:
+                continue
+            if elev is not None:
+                self.buffer[(parent, job)] = elev
+                self.size += elev.nbytes
+                while self.size > self.cap and self.buffer:
+                    _, old = self.buffer.popitem(last=False)
+                    self.size -= old.nbytes
+                    self.evicted += 1
+            self.pending[parent] -= 1
+            if self.pending[parent] == 0:
+                if parent in self.done:
+                    # resuming: it is in the mbtiles already, its root is not
+                    for child in self.children[parent]:
+                        old = self.buffer.pop((parent, child), None)
+                        if old is not None:
+                            self.size -= old.nbytes
+                    todo.append((parent, None))
+                else:
+                    ready.append(self._job(parent))
+        return ready
+
+
+# --------------------------------------------------------------------------
+# updates
+# --------------------------------------------------------------------------
+
+
+def source_manifest(specs, workdir):
+    """
+    What each source is made of, kept in the output for --update: its spec,
+    and its files with their mtime, size and wgs84 box. The boxes the prepare
+    step did not find are read through `_bounds_index`, cached in --workdir
+    like those of the mosaics
+    """
+    out = []
+    for spec in specs:
+        conf = {k: v for k, v in spec.items() if not k.startswith("_")}
+        conf.pop("allow_full_download", None)
+        conf.pop("download", None)
+        files = spec.get("_files") or []
+        boxes = {}
+        unboxed = [f[0] for f in files if f[3] is None]
+        if unboxed:
+            boxes = _bounds_index(
+                unboxed,
+                os.path.join(workdir, spec["name"]),
+                spec.get("crs"),
+                spec.get("_jobs", 1),
+            )
+        files = [[p, mtime, size, box or boxes.get(p)] for p, mtime, size, box in files]
+        out.append({"name": spec["name"], "spec": conf, "files": files})
+    # as read back from the metadata
+    return json.loads(json.dumps(out))
+
+
+def changed_areas(old, new):
+    """
+    What changed from one manifest to the other, the files added, removed or
+    modified, as (path, wgs84 box) for their old and new version. None when
+    it cannot be told where: a spec changed, the sources were reordered (they
+    are composited in order), or a file has no box
+    """
+    old_sources = {s["name"]: s for s in old}
+    new_sources = {s["name"]: s for s in new}
+    if [s["name"] for s in old if s["name"] in new_sources] != [
+        s["name"] for s in new if s["name"] in old_sources
+    ]:
+        return None
+    changes = []
+    for name in sorted(set(old_sources) | set(new_sources)):
+        before, after = old_sources.get(name), new_sources.get(name)
+        if before and after and before["spec"] != after["spec"]:
+            return None
+        before = {tuple(f[:3]): f[3] for f in (before["files"] if before else ())}
+        after = {tuple(f[:3]): f[3] for f in (after["files"] if after else ())}
+        for key in sorted(set(before) ^ set(after)):
+            box = before.get(key) or after.get(key)
+            if box is None:
+                return None
+            changes.append((key[0], box))
+    return changes
+
+
+def dirty_jobs(levels, boxes, halo, tile_size, store):
+    """
+    The jobs a change in the wgs84 `boxes` reaches: those whose root tile,
+    grown by the halo at the resolution of the root zoom, touches one. That
+    covers every warp of the job, down to the tiles re-warped at its root
+    zoom, and the ancestors of a job reached are reached as well.
+
+    A job redone averages the roots of its children. Those in `store` are
+    read back from the output, the helpers went with the scratch store: the
+    children they are the root of are redone too, rather than re-warping
+    their parent from the dem at a low zoom
+    """
+    if not boxes:
+        return set()
+    b = np.array(boxes, dtype=np.float64)
+    x0, y0 = to_mercator(b[:, 0], b[:, 1])
+    x1, y1 = to_mercator(b[:, 2], b[:, 3])
+    tree = shapely.STRtree(shapely.box(x0, y0, x1, y1))
+    jobs = sorted(set().union(*(roots for _, _, roots in levels)))
+    windows = []
+    for job in jobs:
+        w, s, e, n = mercantile.xy_bounds(*job)
+        m = halo * (e - w) / tile_size
+        windows.append((w - m, s - m, e + m, n + m))
+    hit = tree.query(shapely.box(*np.array(windows).T), predicate="intersects")[0]
+    dirty = {jobs[i] for i in np.unique(hit)}
+    for (rz, _, _), (_, _, children) in zip(levels[:0:-1], levels[-2::-1]):
+        for x, y, z in children:
+            parent = (x >> (z - rz), y >> (z - rz), rz)
+            if parent in dirty and (x, y, z) not in store.get(z, ()):
+                dirty.add((x, y, z))
+    return dirty
+
+
+# --------------------------------------------------------------------------
+# planning
+# --------------------------------------------------------------------------
+
+# peak of a worker, measured: python, numpy, rasterio and gdal loaded, then
+# per pixel of the warped block (halo included) the output and one source
+# warped, its mask and weight, the blur and blend temporaries. the sources are
+# composited one after the other, each only adds its datasets and their cache
+WORKER_BASE = 100 << 20
+SOURCE_BASE = 16 << 20
+BLOCK_BYTES_PER_PX = 36
+# the main process, on top of --pyramid-memory
+MAIN_BASE = 200 << 20
+
+
+def worker_memory(macro_levels, tile_size, halo, n_sources):
+    """rough peak bytes of one worker warping macrotiles of macro_levels"""
+    full = 2 ** macro_levels * tile_size + 2 * halo
+    return WORKER_BASE + n_sources * SOURCE_BASE + BLOCK_BYTES_PER_PX * full * full
+
+
+def plan(wanted, minzoom, maxzoom, tile_size, halo, n_sources, workers, budget, pyramid):
+    """
+    One row per --macro-levels from 0 to 4: macrotiles, warped pixels, peak
+    memory per worker, and the workers that fit in `budget` bytes next to the
+    main process and its `pyramid` buffer (all of `workers` without a budget).
+    Cost is the warped pixels per worker, the halo is what larger macrotiles
+    save: at --blur 1000 and z14 it is wider than a 512px tile.
+    """
+    rows = []
+    for macro_levels in range(5):
+        jobs = len(pyramid_levels(wanted, minzoom, maxzoom, macro_levels)[0][2])
+        full = 2 ** macro_levels * tile_size + 2 * halo
+        per_worker = worker_memory(macro_levels, tile_size, halo, n_sources)
+        fit = workers
+        if budget:
+            fit = min(workers, max(0, (budget - MAIN_BASE - pyramid) // per_worker))
+        rows.append(
+            {
+                "macro_levels": macro_levels,
+                "jobs": jobs,
+                "warped": jobs * full * full,
+                "overhead": (full * full) / float((full - 2 * halo) ** 2) - 1,
+                "worker_memory": per_worker,
+                "workers": fit,
+                "cost": jobs * full * full / float(fit) if fit else float("inf"),
+            }
+        )
+    return rows
+
+
+def log_plan(rows, chosen):
+    log("macro  jobs      warped Mpx  halo  worker MB  workers  cost")
+    for r in rows:
+        log(
+            "%s%-5d %-9d %-11d %3d%%  %-9d  %-7d  %s"
+            % (
+                "*" if r["macro_levels"] == chosen else " ",
+                r["macro_levels"],
+                r["jobs"],
+                r["warped"] // 1000000,
+                round(100 * r["overhead"]),
+                r["worker_memory"] >> 20,
+                r["workers"],
+                "-" if not r["workers"] else "%d Mpx/worker" % (r["cost"] // 1000000),
+            )
+        )
+
+
+# --------------------------------------------------------------------------
+# profiling
+# --------------------------------------------------------------------------
+
+
+def _histogram_key(ms, unit):
+    """the power of two bucket of a value"""
+    b = 1
+    while b < ms:
+        b *= 2
+    return "<=%d%s" % (b, unit)
+
+
+class ProfileReport(object):
+    """
+    The --profile report: the wall time of every stage, overall, per zoom and
+    per source, as count, total, max and a histogram in power of two
+    milliseconds, and the peak RSS of the workers per macrotile, per zoom.
+    Stages nest (a composite holds its warps and blurs), each counts its own
+    wall time in full. With `trace`, every event is also streamed to a Chrome
+    trace, to open in ui.perfetto.dev or chrome://tracing.
+    """
+
+    def __init__(self, trace=None):
+        self.start = time.time()
+        # (group, key, stage) -> [count, seconds, max seconds, histogram]
+        self.stages = {}
+        # zoom -> [macrotiles, max bytes, histogram]
+        self.rss = {}
+        self.trace = None
+        if trace:
+            self.trace = open(trace, "w")
+            self.trace.write("[\n")
+            self.trace_first = True
+
+    def _stage(self, group, key, name, seconds):
+        entry = self.stages.setdefault((group, key, name), [0, 0.0, 0.0, collections.Counter()])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        entry[3][_histogram_key(seconds * 1000.0, "ms")] += 1
+
+    def add(self, events, rss=None, zoom=None):
+        """the events of a job, and the peak RSS of the worker that ran it"""
+        for name, tags, pid, thread, start, seconds in events:
+            self._stage("stages", None, name, seconds)
+            if "zoom" in tags:
+                self._stage("zooms", tags["zoom"], name, seconds)
+            if "source" in tags:
+                self._stage("sources", tags["source"], name, seconds)
+            if self.trace is not None:
+                self.trace.write(
+                    "%s%s"
+                    % (
+                        "" if self.trace_first else ",\n",
+                        json.dumps(
+                            {
+                                "name": name,
+                                "ph": "X",
+                                "ts": round((start - self.start) * 1e6),
+                                "dur": round(seconds * 1e6),
+                                "pid": pid,
+                                "tid": thread,
+                                "args": tags,
+                            }
+                        ),
+                    )
+                )
+                self.trace_first = False
+        if rss:
+            entry = self.rss.setdefault(zoom, [0, 0, collections.Counter()])
+            entry[0] += 1
+            entry[1] = max(entry[1], rss)
+            entry[2][_histogram_key(rss / float(1 << 20), "MB")] += 1
+
+    @staticmethod
+    def _summary(entry):
+        count, seconds, longest, histogram = entry
+        return {
+            "count": count,
+            "total_s": round(seconds, 3),
+            "mean_ms": round(1000.0 * seconds / count, 3),
+            "max_ms": round(1000.0 * longest, 3),
+            "histogram": dict(sorted(histogram.items(), key=lambda kv: int(kv[0][2:-2]))),
+        }
+
+    def write(self, path):
+        report = {
+            "wall_s": round(time.time() - self.start, 3),
+            "stages": {},
+            "zooms": {},
+            "sources": {},
+        }
+        for (group, key, name), entry in sorted(self.stages.items(), key=lambda kv: str(kv[0])):
+            target = report[group] if key is None else report[group].setdefault(str(key), {})
+            target[name] = self._summary(entry)
+        report["peak_rss"] = {
+            str(z): {
+                "macrotiles": n,
+                "max_mb": round(peak / float(1 << 20), 1),
+                "histogram": dict(sorted(h.items(), key=lambda kv: int(kv[0][2:-2]))),
+            }
+            for z, (n, peak, h) in sorted(self.rss.items())
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        if self.trace is not None:
+            self.trace.write("\n]\n")
+            self.trace.close()
+        return report
+
+    def log(self):
+        for (group, key, name), (count, seconds, _, _) in sorted(
+            self.stages.items(), key=lambda kv: -kv[1][1]
+        ):
+            if group == "stages":
+                log("  %-10s %8d x %9.1fs" % (name, count, seconds))
+
+
+# --------------------------------------------------------------------------
+# mbtiles
+# --------------------------------------------------------------------------
+
+
+def blob_id(blob):
+    """
+    tiles_data key of a blob, from its content: every sea tile, every tile of
+    the ring past the sources, shares one row. 64 bits of blake2b, signed to
+    fit an sqlite integer, a collision is not a practical concern
+    """
+    return int.from_bytes(hashlib.blake2b(blob, digest_size=8).digest(), "big", signed=True)
+
+
+class MBTiles(object):
+    """
+    The output, in the compact tiles_data/tiles_shallow layout. With `resume`
+    an existing file is kept, along with the side tables recording how far the
+    build that wrote it got.
+
+    `scratch` is a database attached next to it for the helper tiles, those only
+    needed to average the zoom below: they never enter the output, which then
+    never has to be rewritten by a VACUUM to get rid of them.
+    """
+
+    def __init__(self, path, resume=False, scratch=None):
+        for p in (path, scratch):
+            if p and os.path.exists(p) and not resume:
+                os.unlink(p)
+        self.scratch = scratch
+        # written from the TileWriter thread, read from the main one once the
+        # writer is flushed, never both at once
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA synchronous=OFF")
+        # the TileWriter transactions are large, a build killed in one of them
+        # has to find the file as it was at the last commit. a rollback journal
+        # on disk does that, and unlike WAL it also commits the output and the
+        # scratch together
+        cur.execute("PRAGMA journal_mode=DELETE")
+        if resume:
+            self._check(path, "main")
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS tiles_data "
+            "(tile_data_id integer primary key, tile_data blob);"
+        )
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS tiles_shallow (zoom_level integer, "
+            "tile_column integer, tile_row integer, tile_data_id integer, "
+            "primary key(zoom_level,tile_column,tile_row)) without rowid;"
+        )
+        cur.execute(
+            "CREATE VIEW IF NOT EXISTS tiles AS SELECT "
+            "tiles_shallow.zoom_level as zoom_level, "
+            "tiles_shallow.tile_column as tile_column, "
+            "tiles_shallow.tile_row as tile_row, tiles_data.tile_data as tile_data "
+            "FROM tiles_shallow JOIN tiles_data on "
+            "tiles_shallow.tile_data_id = tiles_data.tile_data_id"
+        )
+        cur.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text);")
+        # checkpoints: the macrotiles whose tiles are in, and the build state
+        # (parameters, finished zooms). dropped once the build completes
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS build_jobs (zoom_level integer, "
+            "tile_column integer, tile_row integer, "
+            "primary key(zoom_level,tile_column,tile_row)) without rowid;"
+        )
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS build_state (name text primary key, value text);"
+        )
+        # float32 roots a shard leaves to the merge, so that the zooms it
+        # finishes come out as they would from a single build
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS build_roots (zoom_level integer, "
+            "tile_column integer, tile_row integer, elev blob, "
+            "primary key(zoom_level,tile_column,tile_row)) without rowid;"
+        )
+        if scratch:
+            cur.execute("ATTACH DATABASE ? AS scratch", (scratch,))
+            cur.execute("PRAGMA scratch.synchronous=OFF")
+            cur.execute("PRAGMA scratch.journal_mode=DELETE")
+            if resume:
+                self._check(scratch, "scratch")
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS scratch.helpers (zoom_level integer, "
+                "tile_column integer, tile_row integer, tile_data blob, "
+                "primary key(zoom_level,tile_column,tile_row)) without rowid;"
+            )
+        self.conn.commit()
+
+    def _check(self, path, schema):
+        """
+        a file an older build left corrupt, killed with its journal in memory,
+        would otherwise be resumed and stay corrupt
+        """
+        try:
+            problems = [
+                row[0] for row in self.conn.execute("PRAGMA %s.quick_check" % schema)
+            ]
+        except sqlite3.DatabaseError as exc:
+            problems = [str(exc)]
+        if problems != ["ok"]:
+            self.conn.close()
+            raise SystemExit(
+                "%s is corrupt, the build has to start over:\n  %s"
+                % (path, "\n  ".join(problems[:10]))
+            )
+
+    def state(self, name):
+        row = self.conn.execute(
+            "SELECT value FROM build_state WHERE name=?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, name, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO build_state (name, value) VALUES (?, ?)",
+            (name, str(value)),
+        )
+
+    def done_jobs(self):
+        return {
+            (x, y, z)
+            for z, x, y in self.conn.execute(
+                "SELECT zoom_level, tile_column, tile_row FROM build_jobs"
+            )
+        }
+
+    def job_done(self, job):
+        """recorded in the same transaction as the tiles of that job"""
+        x, y, z = job
+        self.conn.execute(
+            "INSERT OR REPLACE INTO build_jobs (zoom_level, tile_column, tile_row) "
+            "VALUES (?, ?, ?)",
+            (z, x, y),
+        )
+
+    def drop_build_state(self):
+        self.conn.execute("DROP TABLE IF EXISTS build_jobs")
+        self.conn.execute("DROP TABLE IF EXISTS build_state")
+        self.conn.execute("DROP TABLE IF EXISTS build_roots")
+        self.conn.commit()
+
+    def put_roots(self, roots):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO build_roots "
+            "(zoom_level, tile_column, tile_row, elev) VALUES (?, ?, ?, ?)",
+            [
+                (z, x, y, sqlite3.Binary(elev.astype(np.float32).tobytes()))
+                for (x, y, z), elev in roots
+            ],
+        )
+
+    def get_root(self, tile):
+        x, y, z = tile
+        row = self.conn.execute(
+            "SELECT elev FROM build_roots WHERE zoom_level=? AND tile_column=? "
+            "AND tile_row=?",
+            (z, x, y),
+        ).fetchone()
+        if row is None:
+            return None
+        elev = np.frombuffer(row[0], dtype=np.float32)
+        side = int(round(math.sqrt(elev.size)))
+        return elev.reshape(side, side).copy()
+
+    def merge(self, path):
+        """
+        Add the tiles, checkpoints and roots of a shard. The shards own disjoint
+        jobs and blobs are keyed by their content, so the order does not matter
+        """
+        self.conn.execute("ATTACH DATABASE ? AS shard", (path,))
+        for sql in (
+            "INSERT OR IGNORE INTO tiles_data SELECT * FROM shard.tiles_data",
+            "INSERT OR REPLACE INTO tiles_shallow SELECT * FROM shard.tiles_shallow",
+            "INSERT OR REPLACE INTO build_jobs SELECT * FROM shard.build_jobs",
+            "INSERT OR REPLACE INTO build_roots SELECT * FROM shard.build_roots",
+        ):
+            self.conn.execute(sql)
+        self.conn.commit()
+        self.conn.execute("DETACH DATABASE shard")
+
+    def put_many(self, tiles):
+        data, shallow = [], []
+        for (x, y, z), blob in tiles:
+            tile_id = blob_id(blob)
+            data.append((tile_id, sqlite3.Binary(blob)))
+            shallow.append((z, x, (1 << z) - y - 1, tile_id))
+        cur = self.conn.cursor()
+        cur.executemany(
+            "INSERT OR IGNORE INTO tiles_data (tile_data_id, tile_data) VALUES (?, ?)",
+            data,
+        )
+        cur.executemany(
+            "INSERT OR REPLACE INTO tiles_shallow "
+            "(zoom_level, tile_column, tile_row, tile_data_id) VALUES (?, ?, ?, ?)",
+            shallow,
+        )
+
+    def get(self, tile):
+        x, y, z = tile
+        flipped = int(math.pow(2, z)) - y - 1
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? "
+            "AND tile_row=?",
+            (z, x, flipped),
+        )
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def put_helpers(self, tiles):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO scratch.helpers "
+            "(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+            [(z, x, y, sqlite3.Binary(blob)) for (x, y, z), blob in tiles],
+        )
+
+    def get_helper(self, tile):
+        x, y, z = tile
+        row = self.conn.execute(
+            "SELECT tile_data FROM scratch.helpers WHERE zoom_level=? AND "
+            "tile_column=? AND tile_row=?",
+            (z, x, y),
+        ).fetchone()
+        return row[0] if row else None
+
+    def drop_helpers(self, tiles):
+        """once their parent is built, nothing reads them anymore"""
+        self.conn.executemany(
+            "DELETE FROM scratch.helpers WHERE zoom_level=? AND tile_column=? "
+            "AND tile_row=?",
+            [(z, x, y) for x, y, z in tiles],
+        )
+
+    def prune(self):
+        """drop the blobs no tile points to anymore, returns how many"""
+        cur = self.conn.execute(
+            "DELETE FROM tiles_data WHERE tile_data_id NOT IN "
+            "(SELECT tile_data_id FROM tiles_shallow)"
+        )
+        return cur.rowcount
+
+    def counts(self):
+        """number of tiles, and of distinct blobs"""
+        return (
+            self.conn.execute("SELECT count(*) FROM tiles_shallow").fetchone()[0],
+            self.conn.execute("SELECT count(*) FROM tiles_data").fetchone()[0],
+        )
+
+    def get_metadata(self, name):
+        row = self.conn.execute("SELECT value FROM metadata WHERE name=?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def put_manifest(self, sources):
+        """
+        the files of the source manifest, a row each: there can be a hundred
+        thousand of them, too many for a value of the metadata. committed with
+        the metadata
+        """
+        cur = self.conn.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS terrain_files "
+            "(source text, path text, mtime, size integer, box text)"
+        )
+        cur.execute("DELETE FROM terrain_files")
+        cur.executemany(
+            "INSERT INTO terrain_files (source, path, mtime, size, box) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (s["name"], path, mtime, size, json.dumps(box) if box else None)
+                for s in sources
+                for path, mtime, size, box in s["files"]
+            ],
+        )
+
+    def get_manifest(self):
+        """the manifest `terrain_build` and `put_manifest` left, or None"""
+        manifest = self.get_metadata("terrain_build")
+        if manifest is None:
+            return None
+        manifest = json.loads(manifest)
+        if not self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='terrain_files'"
+        ).fetchone():
+            # an older output, with the files in the metadata
+            return manifest
+        files = {s["name"]: s.setdefault("files", []) for s in manifest["sources"]}
+        for source, path, mtime, size, box in self.conn.execute(
+            "SELECT source, path, mtime, size, box FROM terrain_files ORDER BY rowid"
+        ):
+            files[source].append([path, mtime, size, json.loads(box) if box else None])
+        return manifest
+
+    def metadata(self, items):
+        cur = self.conn.cursor()
+        cur.execute("DELETE FROM metadata")
+        for k, v in items.items():
+            cur.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", (k, str(v)))
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        if self.scratch:
+            self.conn.execute("DETACH DATABASE scratch")
+        self.conn.close()
+
+    def drop_scratch(self):
+        if self.scratch and os.path.exists(self.scratch):
+            os.unlink(self.scratch)
+
+
+# --------------------------------------------------------------------------
+# pmtiles
+# --------------------------------------------------------------------------
+
+PMTILES_HEADER = struct.Struct("<7sBQQQQQQQQQQQBBBBBBiiiiBii")
+PMTILES_ROOT_MAX = 16384
+PMTILES_TYPES = {"pbf": 1, "png": 2, "webp": 4}
+
+
+def tile_id(x, y, z):
+    """PMTiles v3 id of a tile: the tiles of the zooms above, then the
+    position of the tile along the hilbert curve of its zoom"""
+    acc = ((1 << (2 * z)) - 1) // 3
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx = s & x
+        ry = s & y
+        acc += ((3 * rx) ^ ry) << a
+        if not ry:
+            if rx:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+    return acc
+
+
+def _varints(values):
+    out = bytearray()
+    for v in values:
+        v = int(v)
+        while v >= 0x80:
+            out.append((v & 0x7F) | 0x80)
+            v >>= 7
+        out.append(v)
+    return out
+
+
+def _directory(ids, runs, lengths, offsets):
+    """a gzipped directory, offsets written as 0 when they follow the entry before"""
+    n = len(ids)
+    follows = np.zeros(n, dtype=bool)
+    follows[1:] = offsets[1:] == offsets[:-1] + lengths[:-1]
+    body = _varints([n])
+    body += _varints(np.diff(ids, prepend=0))
+    body += _varints(runs)
+    body += _varints(lengths)
+    body += _varints(np.where(follows, 0, offsets + 1))
+    return gzip.compress(bytes(body), mtime=0)
+
+
+class PMTiles(object):
+    """
+    The output as a PMTiles v3 archive, for the static object store. It takes
+    the calls of MBTiles, without --resume.
+
+    The blobs are spooled to `spool` as they come, each distinct blob once,
+    and only (tile id, spool offset, length) is kept per tile, with a dict
+    from the id to its last write for `get`. `close` then sorts the tiles
+    along the hilbert curve, works out the directories, and copies each blob
+    once in that order after them: the archive is clustered,
+    identical tiles share their bytes and consecutive ones collapse into a
+    run, and nothing goes through sqlite but the helper tiles in `scratch`.
+    """
+
+    def __init__(self, path, scratch, spool):
+        for p in (path, scratch, spool):
+            if os.path.exists(p):
+                os.unlink(p)
+        self.path = path
+        self.scratch = scratch
+        self.spool_path = spool
+        self.spool = open(spool, "w+b")
+        self.size = 0
+        self.blobs = {}
+        self.ids = array.array("Q")
+        self.offsets = array.array("Q")
+        self.lengths = array.array("I")
+        # tile id -> its last write, for the roots read back by `get`
+        self.index = {}
+        self.items = {}
+        self.conn = sqlite3.connect(scratch, check_same_thread=False)
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("PRAGMA journal_mode=MEMORY")
+        self.conn.execute(
+            "CREATE TABLE helpers (zoom_level integer, tile_column integer, "
+            "tile_row integer, tile_data blob, "
+            "primary key(zoom_level,tile_column,tile_row)) without rowid;"
+        )
+
+    # nothing is recorded to resume from
+    def set_state(self, name, value):
+        pass
+
+    def put_roots(self, roots):
+        pass
+
+    def get_root(self, tile):
+        return None
+
+    def job_done(self, job):
+        pass
+
+    def drop_build_state(self):
+        pass
+
+    def prune(self):
+        return 0
+
+    def put_many(self, tiles):
+        for (x, y, z), blob in tiles:
+            key = blob_id(blob)
+            offset = self.blobs.get(key)
+            if offset is None:
+                offset = self.blobs[key] = self.size
+                self.spool.seek(offset)
+                self.spool.write(blob)
+                self.size += len(blob)
+            tid = tile_id(x, y, z)
+            self.index[tid] = len(self.ids)
+            self.ids.append(tid)
+            self.offsets.append(offset)
+            self.lengths.append(len(blob))
+
+    def get(self, tile):
+        i = self.index.get(tile_id(*tile))
+        if i is None:
+            return None
+        self.spool.seek(self.offsets[i])
+        return self.spool.read(self.lengths[i])
+
+    def put_helpers(self, tiles):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO helpers "
+            "(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+            [(z, x, y, sqlite3.Binary(blob)) for (x, y, z), blob in tiles],
+        )
+
+    def get_helper(self, tile):
+        x, y, z = tile
+        row = self.conn.execute(
+            "SELECT tile_data FROM helpers WHERE zoom_level=? AND tile_column=? "
+            "AND tile_row=?",
+            (z, x, y),
+        ).fetchone()
+        return row[0] if row else None
+
+    def drop_helpers(self, tiles):
+        self.conn.executemany(
+            "DELETE FROM helpers WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            [(z, x, y) for x, y, z in tiles],
+        )
+
+    def counts(self):
+        return len(self.ids), len(self.blobs)
+
+    def metadata(self, items):
+        self.items = dict(items)
+
+    def commit(self):
+        self.spool.flush()
+        self.conn.commit()
+
+    def _entries(self):
+        """
+        The tiles in hilbert order, last write of a tile winning: their ids,
+        run lengths, offsets in the tile data, lengths, and the spool offsets
+        of the distinct blobs in the order they are copied
+        """
+        ids = np.frombuffer(self.ids, dtype=np.uint64)
+        order = np.argsort(ids, kind="stable")
+        ids = ids[order]
+        last = np.ones(len(ids), dtype=bool)
+        last[:-1] = ids[:-1] != ids[1:]
+        order, ids = order[last], ids[last]
+        spooled = np.frombuffer(self.offsets, dtype=np.uint64)[order]
+        lengths = np.frombuffer(self.lengths, dtype=np.uint32)[order].astype(np.uint64)
+        # a blob goes where its first tile along the curve is
+        blobs, first, inverse = np.unique(spooled, return_index=True, return_inverse=True)
+        copy = np.argsort(first, kind="stable")
+        sizes = lengths[first[copy]]
+        placed = np.empty(len(blobs), dtype=np.uint64)
+        placed[copy] = np.cumsum(sizes) - sizes
+        offsets = placed[inverse.ravel()]
+        # consecutive ids sharing a blob are one entry
+        start = np.ones(len(ids), dtype=bool)
+        start[1:] = (ids[1:] != ids[:-1] + 1) | (offsets[1:] != offsets[:-1])
+        heads = np.flatnonzero(start)
+        runs = np.diff(np.append(heads, len(ids)))
+        copied = [(int(blobs[b]), int(sizes[i])) for i, b in enumerate(copy)]
+        return ids[heads], runs, offsets[heads], lengths[heads], copied
+
+    def _directories(self, ids, runs, offsets, lengths):
+        """the root directory, and the leaves if it does not fit in the first 16k"""
+        root = _directory(ids, runs, lengths, offsets)
+        if PMTILES_HEADER.size + len(root) <= PMTILES_ROOT_MAX:
+            return root, b""
+        leaf_size = 4096
+        while True:
+            heads, sizes, leaves = [], [], []
+            for i in range(0, len(ids), leaf_size):
+                s = slice(i, i + leaf_size)
+                leaves.append(_directory(ids[s], runs[s], lengths[s], offsets[s]))
+                heads.append(ids[i])
+                sizes.append(len(leaves[-1]))
+            sizes = np.array(sizes, dtype=np.uint64)
+            root = _directory(
+                np.array(heads, dtype=np.uint64),
+                np.zeros(len(heads), dtype=np.uint64),
+                sizes,
+                np.cumsum(sizes) - sizes,
+            )
+            if PMTILES_HEADER.size + len(root) <= PMTILES_ROOT_MAX:
+                return root, b"".join(leaves)
+            leaf_size *= 2
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+        ids, runs, offsets, lengths, copied = self._entries()
+        root, leaves = self._directories(ids, runs, offsets, lengths)
+        # the vector_layers of an mbtiles go in its "json" row, here they are
+        # keys of the metadata itself
+        items = dict(self.items)
+        items.update(json.loads(items.pop("json", "{}")))
+        meta = gzip.compress(json.dumps(items).encode("utf-8"), mtime=0)
+        west, south, east, north = (
+            float(v) for v in self.items.get("bounds", "-180,-85,180,85").split(",")
+        )
+        minzoom = int(self.items.get("minzoom", 0))
+        meta_offset = PMTILES_HEADER.size + len(root)
+        leaves_offset = meta_offset + len(meta)
+        data_offset = leaves_offset + len(leaves)
+        header = PMTILES_HEADER.pack(
+            b"PMTiles",
+            3,
+            PMTILES_HEADER.size,
+            len(root),
+            meta_offset,
+            len(meta),
+            leaves_offset,
+            len(leaves),
+            data_offset,
+            sum(size for _, size in copied),
+            int(runs.sum()),
+            len(ids),
+            len(copied),
+            1,  # clustered
+            2,  # gzip directories and metadata
+            2 if self.items.get("format") == "pbf" else 1,  # the mvt tiles are gzipped
+            PMTILES_TYPES.get(self.items.get("format"), 0),
+            minzoom,
+            int(self.items.get("maxzoom", minzoom)),
+            int(west * 1e7),
+            int(south * 1e7),
+            int(east * 1e7),
+            int(north * 1e7),
+            minzoom,
+            int((west + east) / 2 * 1e7),
+            int((south + north) / 2 * 1e7),
+        )
+        with open(self.path, "wb") as out:
+            out.write(header)
+            out.write(root)
+            out.write(meta)
+            out.write(leaves)
+            for offset, size in copied:
+                self.spool.seek(offset)
+                out.write(self.spool.read(size))
+        self.spool.close()
+
+    def drop_scratch(self):
+        for p in (self.scratch, self.spool_path):
+            if os.path.exists(p):
+                os.unlink(p)
+
+
+class TileWriter(object):
+    """
+    Writes to an MBTiles or a PMTiles on a thread of its own, so that the main process
+    keeps draining the workers. Each item of the queue is the tiles of one job,
+    written with executemany along with the checkpoint of their job, and
+    committed every `commit_every` tiles or `commit_seconds`, whichever comes
+    first, so that --resume does not lose much.
+
+    The queue is bounded: when the writer falls behind, `put` blocks and that
+    time is counted in `blocked`. When it is the warping that falls behind, the
+    writer waits on an empty queue, counted in `starved`.
+    """
+
+    FLUSH = object()
+
+    def __init__(self, db, maxsize=256, commit_every=4096, commit_seconds=30.0):
+        self.db = db
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.tiles = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.starved = 0.0
+        self.max_depth = 0
+        self.thread = threading.Thread(target=self._run, name="tile-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        pending = 0
+        last_commit = time.monotonic()
+        while True:
+            start = time.monotonic()
+            item = self.queue.get()
+            if item is not None:
+                self.starved += time.monotonic() - start
+            try:
+                # after a failure the queue is only drained, down to the None
+                if self.error is None:
+                    start = time.monotonic()
+                    if item is not None and item is not self.FLUSH:
+                        tiles, job, helpers, drop, roots = item
+                        with stage("write", **({"zoom": job[2]} if job else {})):
+                            self.db.put_many(tiles)
+                            if helpers:
+                                self.db.put_helpers(helpers)
+                            if roots:
+                                self.db.put_roots(roots)
+                            if drop:
+                                self.db.drop_helpers(drop)
+                            if job is not None:
+                                self.db.job_done(job)
+                        pending += len(tiles)
+                        self.tiles += len(tiles)
+                    if (
+                        item is None
+                        or item is self.FLUSH
+                        or pending >= self.commit_every
+                        or start - last_commit >= self.commit_seconds
+                    ):
+                        with stage("commit"):
+                            self.db.commit()
+                        pending = 0
+                        last_commit = start
+                    self.busy += time.monotonic() - start
+            except Exception as exc:
+                self.error = exc
+            finally:
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def put(self, tiles, job=None, helpers=(), drop=(), roots=()):
+        """
+        `helpers` go to the scratch store, `drop` are removed from it, `roots`
+        are the float32 roots a shard keeps for the merge
+        """
+        self._check()
+        self.max_depth = max(self.max_depth, self.queue.qsize() + 1)
+        start = time.monotonic()
+        self.queue.put((tiles, job, helpers, drop, roots))
+        self.blocked += time.monotonic() - start
+
+    def flush(self):
+        """wait for everything queued to be committed, the db can then be read"""
+        self.queue.put(self.FLUSH)
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def report(self):
+        return (
+            "writer: %d tiles, busy %.1fs, starved %.1fs on an empty queue, main "
+            "blocked %.1fs on a full one (max depth %d/%d)"
+            % (
+                self.tiles,
+                self.busy,
+                self.starved,
+                self.blocked,
+                self.max_depth,
+                self.queue.maxsize,
+            )
+        )
+
+
+# --------------------------------------------------------------------------
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--sources", required=True, help="json file describing the sources")
+    p.add_argument("--poly-shape", help="osmosis .poly limiting the tiles")
+    p.add_argument("--bounds", help="w,s,e,n instead of --poly-shape")
+    p.add_argument("--minzoom", type=int, default=5)
+    p.add_argument("--maxzoom", type=int, default=12)
     p.add_argument("--round-digits", type=int, default=0)
     p.add_argument("--max-round-digits", type=int, default=0)
+    p.add_argument(
+        "--vertical-step",
+        help="quantize each zoom to a step in metres instead of --round-digits: "
+        "either z:step,... (e.g. 12:0.5,11:1, zooms left out double the step of "
+        "the closest one per zoom out), or a ratio R of the ground resolution at "
+        "45.5N, snapped to a power of two (26.8 is mapterhorn at 512px). Meant for terrarium, "
+        "whose 1/256m interval makes a power of two step exact",
+    )
     p.add_argument("-f", "--format", choices=("webp", "png"), default="webp")
     p.add_argument("--encoding", choices=tuple(ENCODINGS), default="mapbox")
     p.add_argument("--blur", type=float, default=1000.0, help="source fade, in metres")
@@ -675,6 +3128,13 @@ def main():
         help="warp 2^N x 2^N max zoom tiles at once (default 2, so 4x4 tiles)",
     )
     p.add_argument("--nodata-elevation", type=float, default=-10.0)
+    p.add_argument(
+        "--pyramid-memory",
+        type=int,
+        default=2048,
+        help="MB of float32 tiles kept to average the zooms below the macrotiles "
+        "(default 2048). Past it the oldest are decoded back from the mbtiles",
+    )
     p.add_argument(
         "--allow-full-download",
         action="store_true",
@@ -682,10 +3142,171 @@ def main():
         "whole, when the area cannot be worked out before downloading",
     )
     p.add_argument("-j", "--workers", type=int, default=8)
+    p.add_argument(
+        "--download-jobs",
+        type=int,
+        default=4,
+        help="files of a mapterhorn source downloaded at once (default 4)",
+    )
+    p.add_argument(
+        "--memory-budget",
+        type=int,
+        default=0,
+        help="MB the build may use. --macro-levels and --workers (then an upper "
+        "bound) are picked to fit it, from an estimate of the peak memory of a "
+        "worker",
+    )
+    p.add_argument(
+        "--plan",
+        action="store_true",
+        help="print the memory and cost estimate of each --macro-levels, and exit "
+        "without building",
+    )
+    p.add_argument(
+        "--inflight",
+        type=int,
+        default=0,
+        help="jobs submitted to the workers at once (default 2 per worker). This "
+        "bounds the finished tiles waiting for the main process, so memory stays "
+        "flat whatever the size of the area",
+    )
     p.add_argument("--workdir", default=".terrain_rgb")
-    p.add_argument("-o", "--output", required=True)
+    p.add_argument(
+        "--block-cache",
+        help="directory of composited max zoom blocks, keyed by the source files "
+        "under them and the composite parameters. Share it between the builds of "
+        "neighbouring areas: the macrotiles along their border are warped once",
+    )
+    p.add_argument(
+        "--block-cache-size",
+        type=int,
+        default=20480,
+        help="MB the block cache is trimmed to at the end of a build, least "
+        "recently used first (default 20480)",
+    )
+    p.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="the .mbtiles to write, or a .pmtiles, written in one pass from a "
+        "spool in --workdir",
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        help="keep an existing output and only build what it is missing. The "
+        "macrotiles and lower zooms already done are recorded in the mbtiles as "
+        "they are written, so this picks up after a crash or an oom kill",
+    )
+    p.add_argument(
+        "--update",
+        action="store_true",
+        help="rebuild an existing output after its sources changed: the source "
+        "files, with their mtime, size and bounds, are kept in its metadata, and "
+        "only the macrotiles under the files added, removed or modified are "
+        "warped again, along with the lower zooms above them. The other tiles "
+        "are kept as they are",
+    )
+    p.add_argument(
+        "--shard",
+        help="i/N, from 1/N to N/N: build only the i-th of N runs of macrotiles, and "
+        "the lower zooms entirely under them, into a partial mbtiles for --merge",
+    )
+    p.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="SHARD",
+        help="the partial mbtiles of the shards, built with the same arguments: "
+        "combine them into --output and build what they left, the lower zooms "
+        "across the shards",
+    )
+    p.add_argument(
+        "--hillshade",
+        metavar="MBTILES",
+        help="also write a grey shaded relief of the stored tiles there, in the "
+        "same format, from the blocks of the max zoom and the pyramid below",
+    )
+    p.add_argument(
+        "--hillshade-azimuth",
+        type=float,
+        default=315.0,
+        help="direction of the light, in degrees clockwise from north (default 315)",
+    )
+    p.add_argument(
+        "--hillshade-altitude",
+        type=float,
+        default=45.0,
+        help="height of the light above the horizon, in degrees (default 45)",
+    )
+    p.add_argument(
+        "--hillshade-z-factor",
+        type=float,
+        default=1.0,
+        help="vertical exaggeration of the hillshade (default 1)",
+    )
+    p.add_argument(
+        "--contours",
+        metavar="MBTILES",
+        help="also write contour vector tiles there, traced per tile from the "
+        "elevation of its zoom, with the div classes and per zoom filter of "
+        "build_contours.sh",
+    )
+    p.add_argument(
+        "--contour-interval",
+        type=int,
+        default=10,
+        help="metres between two contours, at the deepest zoom (default 10)",
+    )
+    p.add_argument("--contour-minzoom", type=int, default=11)
+    p.add_argument(
+        "--contour-maxzoom",
+        type=int,
+        default=14,
+        help="past --maxzoom, the contours of the max zoom tiles are cut into "
+        "the tiles under them (default 14)",
+    )
+    p.add_argument(
+        "--profile",
+        metavar="JSON",
+        help="time every stage of the build (open, warp and blur per source, "
+        "composite, downsample, encode, write, commit) and the peak RSS of each "
+        "macrotile, and write them there per stage, zoom and source",
+    )
+    p.add_argument(
+        "--profile-trace",
+        metavar="JSON",
+        help="with --profile, also write every timed stage as a Chrome trace",
+    )
     a = p.parse_args()
 
+    report = None
+    if a.profile:
+        PROFILE["events"] = []
+        report = ProfileReport(a.profile_trace)
+
+    shard = None
+    if a.shard:
+        m = re.match(r"^(\d+)/(\d+)$", a.shard)
+        if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+            raise SystemExit("--shard takes i/N with 1 <= i <= N, not %s" % a.shard)
+        shard = int(m.group(1)) - 1, int(m.group(2))
+    if (shard or a.merge) and not a.output.endswith(".mbtiles"):
+        raise SystemExit("--shard and --merge write an .mbtiles")
+    if shard and a.merge:
+        raise SystemExit("--shard and --merge are two separate steps")
+    if a.update and (a.resume or shard or a.merge or not a.output.endswith(".mbtiles")):
+        raise SystemExit("--update takes a finished .mbtiles, not --resume, --shard or --merge")
+    if (a.hillshade or a.contours) and (a.resume or shard or a.merge or a.update):
+        raise SystemExit(
+            "--hillshade and --contours are written in one run, not with --resume, "
+            "--shard, --merge or --update"
+        )
+    if a.contours and not a.minzoom <= a.contour_minzoom <= a.maxzoom <= a.contour_maxzoom:
+        raise SystemExit(
+            "--contour-minzoom must be within --minzoom and --maxzoom, and "
+            "--contour-maxzoom at least --maxzoom"
+        )
+
     if a.max_round_digits < a.round_digits:
         a.max_round_digits = a.round_digits
 
@@ -699,41 +3320,101 @@ def main():
         raise SystemExit("--poly-shape or --bounds is required")
     log("area %s" % (tuple(round(v, 4) for v in bbox),))
 
+    # round digits of each zoom, the encoder snaps the codes to 2^round_digits
+    interval = ENCODINGS[a.encoding][1]
+    if a.vertical_step:
+        try:
+            steps = vertical_steps(a.vertical_step, a.minzoom, a.maxzoom, a.tile_size)
+        except ValueError:
+            raise SystemExit(
+                "--vertical-step takes z:step,... or a ratio, all above 0, not %s"
+                % a.vertical_step
+            )
+        round_digits = {z: round_digits_for_step(step, interval) for z, step in steps.items()}
+    else:
+        round_digits = {
+            z: round_digits_for(z, a.maxzoom, a.round_digits, a.max_round_digits)
+            for z in range(a.minzoom, a.maxzoom + 1)
+        }
+
     os.makedirs(a.workdir, exist_ok=True)
     specs = json.load(open(a.sources))
     specs = specs["sources"] if isinstance(specs, dict) else specs
 
     # what ends up in the mbtiles
-    store = {
-        z: set(tiles_for_zoom(geom, bbox, z, a.tile_buffer))
-        for z in range(a.minzoom, a.maxzoom + 1)
-    }
+    store = select_tiles(geom, bbox, a.minzoom, a.maxzoom, a.tile_buffer)
     # what has to be produced: the stored tiles, plus the children of the tiles
     # stored one zoom below, so that every one of them can be averaged from its
     # own 4 children instead of being warped again. these extras are not written
     wanted = {}
     for z in range(a.minzoom, a.maxzoom + 1):
-        needed = set(store[z])
-        if z > a.minzoom:
-            for px, py, _ in store[z - 1]:
-                for dy in (0, 1):
-                    for dx in (0, 1):
-                        needed.add((px * 2 + dx, py * 2 + dy, z))
-        wanted[z] = sorted(needed)
+        wanted[z] = store[z] | store[z - 1].children() if z > a.minzoom else store[z]
     for z in sorted(wanted):
         extra = len(wanted[z]) - len(store[z])
         log("z%-2d %d tiles%s" % (z, len(store[z]), " (+%d to average" % extra + " the zoom below)" if extra else ""))
 
-    # ---- max zoom, warped once per macrotile
-    macro_z = max(0, a.maxzoom - a.macro_levels)
-    side = 2 ** (a.maxzoom - macro_z)
-    macro_jobs = sorted({(x // side, y // side, macro_z) for x, y, _ in wanted[a.maxzoom]})
-
     blur_px_guess = 0
     max_res = (2 * math.pi * 6378137.0) / (2 ** a.maxzoom * a.tile_size)
     if a.blur:
         blur_px_guess = int(a.blur / max_res)
     halo = 2 * blur_px_guess + 4 if a.blur else 0
+    # the tile windows of --hillshade and --contours need a pixel past the
+    # edges of a job at every zoom they are made at: the max zoom is warped
+    # with a ring of the halo, halved with each zoom averaged down and handed
+    # down the pyramid with the roots, a pixel wide at the lowest zoom
+    ring = 0
+    lowest = [z for z, on in ((a.minzoom, a.hillshade), (a.contour_minzoom, a.contours)) if on]
+    if lowest:
+        ring = 2 ** max(0, a.maxzoom - min(lowest))
+        halo = max(halo, ring)
+
+    if a.memory_budget or a.plan:
+        rows = plan(
+            wanted,
+            a.minzoom,
+            a.maxzoom,
+            a.tile_size,
+            halo,
+            len(specs),
+            a.workers,
+            a.memory_budget << 20,
+            a.pyramid_memory << 20,
+        )
+        if a.memory_budget:
+            best = min(rows, key=lambda r: (r["cost"], r["workers"]))
+            if not best["workers"]:
+                raise SystemExit(
+                    "--memory-budget %d MB does not fit a single worker next to "
+                    "--pyramid-memory %d MB, the smallest takes %d MB"
+                    % (a.memory_budget, a.pyramid_memory, rows[0]["worker_memory"] >> 20)
+                )
+            a.macro_levels, a.workers = best["macro_levels"], best["workers"]
+            log("memory budget %d MB: --macro-levels %d -j %d" % (a.memory_budget, a.macro_levels, a.workers))
+        log_plan(rows, a.macro_levels)
+        if a.plan:
+            return
+
+    # ---- max zoom, warped once per macrotile, then macrotiles of the same
+    # depth down the pyramid, built from the roots of the level above
+    levels = pyramid_levels(wanted, a.minzoom, a.maxzoom, a.macro_levels)
+    frontier = set()
+    if shard:
+        n_macro = len(levels[0][2])
+        levels, frontier = shard_levels(levels, wanted, *shard)
+        log(
+            "shard %s: %d/%d macrotiles, %d jobs, %d roots left to the merge"
+            % (
+                a.shard,
+                len(levels[0][2]),
+                n_macro,
+                sum(len(roots) for _, _, roots in levels),
+                len(frontier),
+            )
+        )
+    macro_z = levels[0][0]
+    side = 2 ** (a.maxzoom - macro_z)
+    macro_jobs = sorted(levels[0][2], key=zorder)
+    all_jobs = set().union(*(roots for _, _, roots in levels))
 
     # the sources have to cover every pixel that gets read, which is the macrotile
     # blocks plus their halo, not the shape. clipping them to the shape leaves the
@@ -753,22 +3434,137 @@ def main():
     for spec in specs:
         if a.allow_full_download:
             spec["allow_full_download"] = True
+        spec["_download_jobs"] = a.download_jobs
+        spec["_jobs"] = a.workers
         log("source %s (%s)" % (spec["name"], spec.get("type", "raster")))
         prepare = PREPARE[spec.get("type", "raster")]
-        spec["_path"] = prepare(spec, source_bbox, a.workdir)
-
-    db = MBTiles(a.output)
+        with stage("prepare", source=spec["name"]):
+            spec["_path"] = prepare(spec, source_bbox, a.workdir)
+
+    resuming = (a.resume and os.path.exists(a.output)) or bool(a.merge)
+    updating = a.update and os.path.exists(a.output)
+    scratch = os.path.join(a.workdir, os.path.basename(a.output) + ".scratch")
+    if a.output.endswith(".pmtiles"):
+        if resuming:
+            raise SystemExit("--resume needs an .mbtiles output, a .pmtiles is written at the end")
+        spool = os.path.join(a.workdir, os.path.basename(a.output) + ".spool")
+        db = PMTiles(a.output, scratch, spool)
+    else:
+        db = MBTiles(a.output, resume=(resuming or updating) and not a.merge, scratch=scratch)
+    # everything that changes the bytes of a tile. resuming with other values
+    # would leave a file mixing two builds
+    params = json.dumps(
+        {
+            "sources": [s["name"] for s in specs],
+            "bbox": [round(v, 6) for v in bbox],
+            "minzoom": a.minzoom,
+            "maxzoom": a.maxzoom,
+            "round_digits": a.round_digits,
+            "max_round_digits": a.max_round_digits,
+            "vertical_step": a.vertical_step,
+            "format": a.format,
+            "encoding": a.encoding,
+            "blur": a.blur,
+            "tile_buffer": a.tile_buffer,
+            "tile_size": a.tile_size,
+            "macro_levels": a.macro_levels,
+            "nodata_elevation": a.nodata_elevation,
+        },
+        sort_keys=True,
+    )
+    done_jobs = set()
+    if a.merge:
+        # a shard is kept as a build to resume, merging them gives one to resume
+        for path in a.merge:
+            part = MBTiles(path, resume=True)
+            previous, part_shard = part.state("params"), part.state("shard")
+            part.close()
+            if previous != params:
+                raise SystemExit(
+                    "%s was not built with the same arguments, or is not a shard:\n"
+                    "  was %s\n  now %s" % (path, previous, params)
+                )
+            log("merging shard %s from %s" % (part_shard, path))
+            db.merge(path)
+        db.set_state("params", params)
+        db.commit()
+    if resuming:
+        previous = db.state("params")
+        if previous is None:
+            raise SystemExit(
+                "%s has no build state to resume from, it is either complete or "
+                "was not written by this script" % a.output
+            )
+        if previous != params:
+            raise SystemExit(
+                "%s was started with other parameters, drop --resume to start "
+                "over:\n  was %s\n  now %s" % (a.output, previous, params)
+            )
+        if not a.merge and db.state("shard") != a.shard:
+            raise SystemExit(
+                "%s was started as shard %s, not %s" % (a.output, db.state("shard"), a.shard)
+            )
+        done_jobs = db.done_jobs() & all_jobs
+        log("resuming: %d/%d jobs already done" % (len(done_jobs), len(all_jobs)))
+    elif updating:
+        if db.state("params") is not None:
+            raise SystemExit(
+                "%s is an unfinished build, finish it with --resume first" % a.output
+            )
+        previous = db.get_manifest()
+        if previous is None:
+            raise SystemExit(
+                "%s has no manifest of its sources, build it once without --update"
+                % a.output
+            )
+        # the sources are compared file by file, the rest has to be the same
+        now = {k: v for k, v in json.loads(params).items() if k != "sources"}
+        if previous["params"] != now:
+            raise SystemExit(
+                "%s was built with other parameters, drop --update to start over:\n"
+                "  was %s\n  now %s" % (a.output, previous["params"], now)
+            )
+        changes = changed_areas(previous["sources"], source_manifest(specs, a.workdir))
+        if changes is None:
+            log("update: a source spec, their order or a file of unknown extent changed")
+            dirty = all_jobs
+        else:
+            dirty = dirty_jobs(levels, [box for _, box in changes], halo, a.tile_size, store)
+            log(
+                "update: %d file(s) added, removed or modified"
+                % len({path for path, _ in changes})
+            )
+        # checkpointed as done, an interrupted update goes on with --resume
+        done_jobs = all_jobs - dirty
+        db.set_state("params", params)
+        for job in done_jobs:
+            db.job_done(job)
+        db.commit()
+        log(
+            "update: %d/%d jobs to redo, %d/%d macrotiles"
+            % (len(dirty), len(all_jobs), len(dirty & set(macro_jobs)), len(macro_jobs))
+        )
+    else:
+        db.set_state("params", params)
+        if shard:
+            db.set_state("shard", a.shard)
+        db.commit()
     log(
-        "z%d: %d tiles in %d macrotiles of %dpx (round-digits %d)"
+        "z%d: %d tiles in %d macrotiles of %dpx (round-digits %d, %gm step)"
         % (
             a.maxzoom,
             len(wanted[a.maxzoom]),
             len(macro_jobs),
             side * a.tile_size,
-            a.round_digits,
+            round_digits[a.maxzoom],
+            2 ** round_digits[a.maxzoom] * interval,
         )
     )
-    if a.max_round_digits == a.round_digits and a.maxzoom > a.minzoom:
+    if (
+        not a.vertical_step
+        and a.max_round_digits == a.round_digits
+        and a.maxzoom > a.minzoom
+    ):
         log(
             "  note: --max-round-digits is %d, so every zoom quantizes the same. "
             "raise it to let the lower zooms compress harder" % a.max_round_digits
@@ -781,96 +3577,236 @@ def main():
         "blur": a.blur,
         "encoding": a.encoding,
         "format": a.format,
-        "round_digits": a.round_digits,
-        "max_round_digits": a.max_round_digits,
+        "round_digits": round_digits,
         "nodata_elev": a.nodata_elevation,
-        "wanted": set(wanted[a.maxzoom]),
+        "wanted": wanted,
+        "store": store,
+        "profile": bool(a.profile),
+        "block_cache": a.block_cache,
+        "block_cache_size": a.block_cache_size << 20,
+        "ring": ring,
+        "hillshade": (
+            (a.hillshade_azimuth, a.hillshade_altitude, a.hillshade_z_factor)
+            if a.hillshade
+            else None
+        ),
+        "contours": (
+            (a.contour_minzoom, a.contour_maxzoom, a.contour_interval) if a.contours else None
+        ),
     }
+    base, interval = ENCODINGS[a.encoding]
 
-    done = 0
-    if a.workers > 1:
+    writer = TileWriter(db)
+    # the outputs made along with the terrain: name -> (path, db, writer)
+    extras = {}
+    for name, path in (("hillshade", a.hillshade), ("contours", a.contours)):
+        if path:
+            if path.endswith(".pmtiles"):
+                # named after the output too, -o and an extra can share a basename
+                stem = os.path.join(a.workdir, "%s.%s" % (os.path.basename(path), name))
+                extra_db = PMTiles(path, stem + ".scratch", stem + ".spool")
+            else:
+                extra_db = MBTiles(path)
+            extras[name] = path, extra_db, TileWriter(extra_db)
+
+    def fallback(tile):
+        writer.flush()
+        elev = db.get_root(tile)
+        if elev is not None:
+            return elev
+        blob = db.get(tile) if tile in store.get(tile[2], ()) else db.get_helper(tile)
+        return None if blob is None else decode(blob, base, interval)
+
+    pyramid = Pyramid(levels, a.pyramid_memory << 20, fallback)
+    todo = collections.deque(pyramid.start(done_jobs))
+    stats = collections.defaultdict(collections.Counter)
+
+    # the jobs of a level only become ready as the level above completes, so
+    # they are submitted as they come, ahead of the macrotiles still waiting:
+    # that frees their inputs early. only a few jobs are queued per worker,
+    # otherwise the ready ones would wait behind every macrotile, and the
+    # results of all of them would pile up here
+    inflight_cap = a.inflight or 2 * a.workers
+    pool = None
+    if todo and a.workers > 1:
         pool = Pool(a.workers, _init_worker, (specs, worker_args))
-        results = pool.imap_unordered(_macro_worker, macro_jobs)
     else:
         _init_worker(specs, worker_args)
-        results = (_macro_worker(j) for j in macro_jobs)
-    for batch in results:
-        for tile, blob in batch:
-            db.put(tile, blob)
+    results = queue.Queue()
+
+    def finished(result):
+        results.put((time.monotonic(), result))
+
+    inflight = 0
+    # time finished results waited for the main process: their worker slot is
+    # only handed a new job once it gets to them
+    held = 0.0
+    done = len(done_jobs)
+    while todo or inflight:
+        if pool is None:
+            result = _macro_worker(todo.popleft())
+        else:
+            while todo and inflight < inflight_cap:
+                pool.apply_async(
+                    _macro_worker,
+                    (todo.popleft(),),
+                    callback=finished,
+                    error_callback=finished,
+                )
+                inflight += 1
+            stamp, result = results.get()
+            held += time.monotonic() - stamp
+            inflight -= 1
+            if isinstance(result, BaseException):
+                pool.terminate()
+                raise result
+        job, batch, helpers, elev, counts, extra_tiles, profile = result
+        if report is not None:
+            report.add(_drain_profile())
+            if profile is not None:
+                report.add(profile["events"], profile["rss"], job[2])
+        drop = [c for c in pyramid.children.get(job, ()) if c not in store.get(c[2], ())]
+        roots = [(job, elev)] if job in frontier and elev is not None else ()
+        writer.put(batch, job, helpers, drop, roots)
+        for name, (_, _, extra_writer) in extras.items():
+            extra_writer.put(extra_tiles[name])
+        for tile, _ in batch:
+            stats[tile[2]]["tiles"] += 1
+        for (z, what), n in counts.items():
+            stats[z][what] += n
+        ready = pyramid.finish(job, elev)
+        todo.extendleft(reversed(ready))
         done += 1
         if done % 20 == 0:
-            db.commit()
-            log("  %d/%d macrotiles" % (done, len(macro_jobs)))
-    db.commit()
-    if a.workers > 1:
+            log("  %d/%d jobs, writer queue %d" % (done, len(all_jobs), writer.depth()))
+    writer.close()
+    log(writer.report())
+    for name, (_, _, extra_writer) in extras.items():
+        extra_writer.close()
+        log("%s %s" % (name, extra_writer.report()))
+    if pool is not None:
         pool.close()
         pool.join()
+        log(
+            "pool: %d in flight at most, results held %.1fs waiting for the main "
+            "process" % (inflight_cap, held)
+        )
 
-    # ---- lower zooms, 2x2 average of the tiles already produced
-    base, interval = ENCODINGS[a.encoding]
-    main_sources = [Source(s) for s in specs]
     for z in range(a.maxzoom - 1, a.minzoom - 1, -1):
-        rd = round_digits_for(z, a.maxzoom, a.round_digits, a.max_round_digits)
-        made = 0
-        rewarped = 0
-        for x, y, _ in wanted[z]:
-            quad = np.empty((a.tile_size * 2, a.tile_size * 2), dtype=np.float64)
-            children = [
-                db.get((x * 2 + dx, y * 2 + dy, z + 1)) for dy in (0, 1) for dx in (0, 1)
-            ]
-            if all(c is not None for c in children):
-                for i, blob in enumerate(children):
-                    dy, dx = divmod(i, 2)
-                    quad[
-                        dy * a.tile_size : (dy + 1) * a.tile_size,
-                        dx * a.tile_size : (dx + 1) * a.tile_size,
-                    ] = decode(blob, base, interval)
-                elev = 0.25 * (
-                    quad[0::2, 0::2]
-                    + quad[1::2, 0::2]
-                    + quad[0::2, 1::2]
-                    + quad[1::2, 1::2]
-                )
-            else:
-                # a tile of the buffer ring can have children outside of the
-                # selection of the zoom below. warping it straight from the dem
-                # is cheaper than widening every zoom down to the max one
-                elev = warp_block(main_sources, worker_args, x, y, z, z)
-                rewarped += 1
-            db.put((x, y, z), encode(elev, base, interval, rd, a.format))
-            made += 1
-        db.commit()
         log(
-            "z%-2d %d tiles (round-digits %d, %d re-warped)"
-            % (z, made, rd, rewarped)
+            "z%-2d %d tiles (round-digits %d, %gm step, %d re-warped)"
+            % (
+                z,
+                stats[z]["tiles"],
+                round_digits[z],
+                2 ** round_digits[z] * interval,
+                stats[z]["re-warped"],
+            )
+        )
+    if a.block_cache:
+        size, kept, dropped = BlockCache(a.block_cache, a.block_cache_size << 20).evict()
+        log(
+            "block cache: %d/%d macrotiles and %d re-warped tiles read from it, "
+            "%d blocks (%d MB) kept, %d evicted"
+            % (
+                stats[a.maxzoom]["cached"],
+                len(macro_jobs),
+                sum(stats[z]["cached"] for z in range(a.minzoom, a.maxzoom)),
+                kept,
+                size >> 20,
+                dropped,
+            )
+        )
+    if pyramid.evicted:
+        log(
+            "%d tiles dropped from the pyramid buffer, raise --pyramid-memory"
+            % pyramid.evicted
         )
 
-    # the extras only existed to average the zoom below, they are not output
-    dropped = 0
-    for z in range(a.minzoom, a.maxzoom + 1):
-        for tile in wanted[z]:
-            if tile not in store[z]:
-                db.delete(tile)
-                dropped += 1
-    if dropped:
-        log("dropped %d tiles only used to average the lower zooms" % dropped)
-        db.vacuum()
+    # a resumed build can have rewritten tiles of a job an earlier run had not
+    # finished, an update the tiles it redid: their old blobs are left behind
+    if resuming or updating:
+        db.prune()
+    if shard:
+        # what is left to the merge: the checkpoints, and the roots it needs
+        log("shard %s done, combine the shards with --merge" % a.shard)
+    else:
+        db.drop_build_state()
+    tiles, blobs = db.counts()
+    log("%d tiles, %d distinct blobs" % (tiles, blobs))
 
-    db.metadata(
-        {
-            "name": os.path.splitext(os.path.basename(a.output))[0],
-            "format": a.format,
-            "type": "baselayer",
+    meta = {
+        "name": os.path.splitext(os.path.basename(a.output))[0],
+        "format": a.format,
+        "type": "baselayer",
+        "version": "1",
+        "description": "%s terrain rgb" % a.encoding,
+        "encoding": a.encoding,
+        "minzoom": a.minzoom,
+        "maxzoom": a.maxzoom,
+        "bounds": ",".join(str(round(v, 6)) for v in bbox),
+    }
+    if not shard and a.output.endswith(".mbtiles"):
+        # what --update compares the sources with next time: the parameters and
+        # the specs in the metadata, the files in a table of their own
+        sources = source_manifest(specs, a.workdir)
+        db.put_manifest(sources)
+        meta["terrain_build"] = json.dumps(
+            {
+                "params": {k: v for k, v in json.loads(params).items() if k != "sources"},
+                "sources": [{k: v for k, v in s.items() if k != "files"} for s in sources],
+            }
+        )
+    db.metadata(meta)
+    db.close()
+    db.drop_scratch()
+    log("wrote %s" % a.output)
+    for name, (path, extra_db, _) in extras.items():
+        meta = {
+            "name": os.path.splitext(os.path.basename(path))[0],
             "version": "1",
-            "description": "%s terrain rgb" % a.encoding,
-            "encoding": a.encoding,
-            "minzoom": a.minzoom,
-            "maxzoom": a.maxzoom,
             "bounds": ",".join(str(round(v, 6)) for v in bbox),
         }
-    )
-    db.close()
-    log("wrote %s" % a.output)
+        if name == "hillshade":
+            meta.update(
+                format=a.format,
+                type="overlay",
+                description="hillshade, azimuth %g, altitude %g, z-factor %g"
+                % (a.hillshade_azimuth, a.hillshade_altitude, a.hillshade_z_factor),
+                minzoom=a.minzoom,
+                maxzoom=a.maxzoom,
+            )
+        else:
+            meta.update(
+                format="pbf",
+                type="overlay",
+                description="contours every %dm" % a.contour_interval,
+                minzoom=a.contour_minzoom,
+                maxzoom=a.contour_maxzoom,
+                json=json.dumps(
+                    {
+                        "vector_layers": [
+                            {
+                                "id": "contour",
+                                "fields": {"ele": "Number", "div": "Number"},
+                                "minzoom": a.contour_minzoom,
+                                "maxzoom": a.contour_maxzoom,
+                            }
+                        ]
+                    }
+                ),
+            )
+        extra_db.drop_build_state()
+        extra_db.metadata(meta)
+        tiles, blobs = extra_db.counts()
+        extra_db.close()
+        extra_db.drop_scratch()
+        log("wrote %s, %d tiles, %d distinct blobs" % (path, tiles, blobs))
+    if report is not None:
+        report.add(_drain_profile())
+        report.write(a.profile)
+        log("profile written to %s, wall time per stage:" % a.profile)
+        report.log()
 
 
 if __name__ == "__main__":
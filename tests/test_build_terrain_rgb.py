@@ -0,0 +1,92 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+sys.path.insert(0, SCRIPTS)
+try:
+    import build_terrain_rgb as btr
+except ImportError as exc:
+    pytest.skip("build_terrain_rgb does not import: %s" % exc, allow_module_level=True)
+
+
+def _wanted(minzoom, maxzoom):
+    """every tile of the z8 tile 132/164, from minzoom to maxzoom"""
+    out = {}
+    for z in range(minzoom, maxzoom + 1):
+        n = 2 ** (z - 8)
+        tiles = [(x, y, z) for x in range(132 * n, 133 * n) for y in range(164 * n, 165 * n)]
+        out[z] = btr.TileSet.from_tiles(z, tiles)
+    return out
+
+
+@pytest.mark.parametrize("macro_levels", range(5))
+def test_pyramid_levels_reach_the_min_zoom(macro_levels):
+    levels = btr.pyramid_levels(_wanted(8, 12), 8, 12, macro_levels)
+    assert levels[-1][0] == 8
+    for rz, bottom, _ in levels[1:]:
+        assert rz < bottom
+
+
+def test_plan_returns(tmp_path):
+    sources = tmp_path / "sources.json"
+    sources.write_text(json.dumps({"sources": [{"name": "dem", "path": "dem.tif"}]}))
+    cmd = [
+        sys.executable,
+        os.path.join(SCRIPTS, "build_terrain_rgb.py"),
+        "--sources", str(sources),
+        "--bounds", "6.0,45.0,6.4,45.3",
+        "--minzoom", "8",
+        "--maxzoom", "12",
+        "--workdir", str(tmp_path / "work"),
+        "--plan",
+        "-o", str(tmp_path / "out.mbtiles"),
+    ]
+    proc = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    assert proc.returncode == 0, proc.stderr
+    # a row per --macro-levels, 0 to 4
+    assert [line.split()[0].lstrip("*") for line in proc.stderr.splitlines()[-5:]] == [
+        "0", "1", "2", "3", "4"
+    ]
+    assert not os.path.exists(tmp_path / "out.mbtiles")
+
+
+def test_tile_writer_close_raises_a_write_error():
+    class Failing(object):
+        def put_many(self, tiles):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        def commit(self):
+            pass
+
+    writer = btr.TileWriter(Failing())
+    writer.put([((0, 0, 0), b"tile")])
+    raised = []
+
+    def close():
+        try:
+            writer.close()
+        except sqlite3.OperationalError as exc:
+            raised.append(exc)
+
+    closing = threading.Thread(target=close, daemon=True)
+    closing.start()
+    closing.join(10)
+    assert not closing.is_alive(), "close() hangs after a failed write"
+    assert raised
+
+
+@pytest.mark.parametrize("spec", ["12:0", "12:-1", "12:1,11:nan", "0", "-26.8"])
+def test_vertical_steps_above_zero(spec):
+    with pytest.raises(ValueError):
+        btr.vertical_steps(spec, 10, 12, 512)
+
+
+def test_vertical_step_ratio_is_mapterhorn():
+    steps = btr.vertical_steps("26.8", 5, 14, 512)
+    assert steps == {z: 2.0 ** (19 - z) / 256 for z in range(5, 15)}